@@ -0,0 +1,181 @@
+import json
+import os
+import sys
+
+import engine
+import instrument
+import physics
+import route
+
+
+class RiderSetup(object):
+    """One rider/equipment combination of the grid, kept as plain values so it's cheap to ship to workers
+    """
+
+    FIELDS = ('weight', 'height', 'ftp', 'bike', 'wheels')
+
+    def __init__(self, weight=90, height=180, ftp=256, bike='emonda', wheels='meilensteins'):
+        self.weight, self.height, self.ftp = float(weight), int(height), int(ftp)
+        self.bike, self.wheels = bike, wheels
+
+    @classmethod
+    def parse(cls, text):
+        """Build a setup from `weight,height,ftp,bike,wheels` (trailing values may be left out)"""
+        return cls(*text.split(','))
+
+    def build(self):
+        rider = physics.Rider(self.weight, self.height, self.ftp)
+        rider.set_bike(physics.BIKES[self.bike])
+        rider.set_wheels(physics.WHEELS[self.wheels])
+        return rider
+
+    def as_dict(self):
+        return {f: getattr(self, f) for f in self.FIELDS}
+
+
+def load_routes(names, client, bundle=None, tolerance=None):
+    """Route profiles by name, along with the reason for any route that couldn't be loaded"""
+    # Every segment is fetched once up front and concurrently, rather than route by route
+    fetcher = route.SegmentFetcher(client)
+    fetcher.prefetch(names, bundle)
+    profiles, errors = {}, {}
+    for name in names:
+        try:
+            profiles[name] = engine.RouteProfile(route.load_route(name, fetcher, bundle, tolerance))
+        except Exception as e:
+            errors[name] = str(e)
+    return profiles, errors
+
+
+def load_workouts(names, loader):
+    return {name: engine.WorkoutProfile(loader.load_workout(name=name)) for name in names}
+
+
+# Read-only grid data, set once per worker process by `_init_worker`, along with the lead-in
+# checkpoints the worker's routes have built up so far
+_ROUTES, _WORKOUTS = {}, {}
+_CHECKPOINTS = None
+
+
+def _init_worker(routes, workouts_):
+    global _ROUTES, _WORKOUTS, _CHECKPOINTS
+    _ROUTES, _WORKOUTS = routes, workouts_
+    _CHECKPOINTS = engine.Checkpoints()
+
+
+def _row(route_name, workout_name, setup, summary=None, error=None):
+    row = {'route': route_name, 'workout': workout_name, **setup.as_dict()}
+    if summary is None:
+        return {**row, 'error': error}
+    return {
+        **row,
+        'laps': summary.completed_laps,
+        'lead_in_done': any(is_lead_in for _, is_lead_in in summary.laps),
+        'lap_completion': summary.partial_distance / summary.active_lap_length,
+        'remaining_km': summary.remaining_distance,
+        'distance_km': summary.distance,
+        'climbed_m': summary.climbed,
+        'error': None,
+    }
+
+
+def _estimate_route(route_name, workout_names, setups):
+    # A single task covers one route, so its workouts x setups grid is stepped as one batch.
+    # The rows come back along with the task's metrics: the rides' counters and the batch's time.
+    profile = _ROUTES[route_name]
+    grid = [(w, s) for w in workout_names for s in setups]
+    metrics = instrument.Metrics()
+    try:
+        with metrics.timer('simulate'):
+            summaries = engine.simulate_batch([(s.build(), _WORKOUTS[w], profile) for w, s in grid], checkpoints=_CHECKPOINTS)
+    except Exception as e:
+        metrics.count('failed_routes')
+        return [_row(route_name, w, s, error=str(e)) for w, s in grid], metrics.as_dict()
+    for summary in summaries:
+        metrics.merge({'counters': summary.metrics.get('counters', {})})
+    return [_row(route_name, w, s, summary) for (w, s), summary in zip(grid, summaries)], metrics.as_dict()
+
+
+def estimate_grid(routes, workouts_, setups, processes=None, metrics=None, errors=None):
+    """Estimate every route x workout x rider setup, fanning routes out over a process pool
+
+    `routes` and `workouts_` map names to (already loaded) `RouteProfile`/`WorkoutProfile`s. They
+    are handed to each worker once when it starts rather than with every task. Results are rows
+    sorted so each rider/workout's best fitting route (least distance left on the lap) comes first.
+    Every task's counters and timers are added to `metrics` (an `instrument.Metrics`) if given.
+    Routes that couldn't be loaded (`errors`, as from `load_routes`) get an error row for each
+    workout and setup.
+    """
+    # Imported here as only fanning out needs it, not the setups and rows sweep and service use
+    from concurrent.futures import ProcessPoolExecutor
+    rows = [_row(name, w, s, error=error) for name, error in (errors or {}).items() for w in workouts_ for s in setups]
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(routes, workouts_)) as pool:
+        tasks = [pool.submit(_estimate_route, name, list(workouts_), setups) for name in routes]
+        for task in tasks:
+            task_rows, task_metrics = task.result()
+            rows.extend(task_rows)
+            if metrics is not None:
+                metrics.merge(task_metrics)
+
+    order = lambda r: (r['workout'], *map(str, (r[f] for f in RiderSetup.FIELDS)), r['error'] is not None, r.get('remaining_km', 0))
+    return sorted(rows, key=order)
+
+
+def write_rows(rows, fp, fmt='csv'):
+    if fmt == 'json':
+        json.dump(rows, fp, indent=2)
+        return
+    # Imported here as only csv output needs it
+    import csv
+    fields = list(dict.fromkeys(k for r in rows for k in r))
+    writer = csv.DictWriter(fp, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    import stream_cache
+    import strava
+    import workouts
+
+    p = argparse.ArgumentParser(prog='ZwiftBatchEstimate')
+
+    p.add_argument('-r', '--route', action='append', help='route to include (default: every route in routes.json)')
+    p.add_argument('-w', '--workout', action='append', help='workout to include (default: every cached workout)')
+    p.add_argument('-R', '--rider', action='append', type=RiderSetup.parse,
+                   help='rider setup as weight,height,ftp,bike,wheels (repeatable)')
+    p.add_argument('-j', '--processes', type=int)
+    p.add_argument('-o', '--output', help='.csv or .json file to write (default: csv to stdout)')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    p.add_argument('--simplify', type=float, help='merge route segments to within this many metres of elevation')
+    p.add_argument('--metrics', help='json file to write counters and timings of loading and every ride to')
+    p.add_argument('--profile', choices=instrument.PROFILERS, help='profile this process (loading and fanning out) and print a report')
+    p.add_argument('--profile-output', help='file to save the raw profile (pstats or tracemalloc snapshot) to')
+    args = p.parse_args()
+
+    with instrument.profiled(args.profile, args.profile_output, stream=sys.stderr):
+        setups = args.rider or [RiderSetup()]
+        client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                           connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                           offline=args.offline)
+        bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+
+        routes, errors = load_routes(args.route or route.route_names(), client, bundle, args.simplify)
+        for name, error in errors.items():
+            print(f'Skipping {name}: {error}', file=sys.stderr)
+        wl = workouts.WorkoutLoader(setups[0].build())
+        workout_profiles = load_workouts(args.workout or wl.cached_workouts(), wl)
+
+        metrics = instrument.Metrics() if args.metrics else None
+        rows = estimate_grid(routes, workout_profiles, setups, args.processes, metrics, errors)
+        if args.output:
+            with open(args.output, 'w', newline='') as f:
+                write_rows(rows, f, 'json' if args.output.endswith('.json') else 'csv')
+        else:
+            write_rows(rows, sys.stdout)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.merge(instrument.METRICS).to_json(indent=2))
@@ -0,0 +1,531 @@
+import asyncio
+import collections
+import copy
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bs4 import BeautifulSoup
+import numpy as np
+
+import engine
+import integrator
+import intervals
+import physics
+import route
+import stream_cache
+import traces
+import workout_store
+import workouts
+import zwift
+
+
+class RateLimited(Exception):
+    """What `SyntheticClient` raises in place of strava's 429"""
+
+    status_code = 429
+
+    def __init__(self, timeout):
+        super().__init__('Rate limit exceeded')
+        self.timeout = timeout
+
+
+class SyntheticClient(object):
+    """Offline stand-in for the strava client with reproducible random segment streams
+
+    Each request can be made to take `latency` seconds, and every `throttle_every`th to be
+    refused as rate limited (retry after `retry_after` seconds).
+    """
+
+    def __init__(self, points=500, latency=0, throttle_every=0, retry_after=.05):
+        self._points = points
+        self._latency = latency
+        self._throttle_every = throttle_every
+        self._retry_after = retry_after
+        self._calls = itertools.count(1)
+        self.requests = 0
+
+    def get_segment_streams(self, segment_id, types=None):
+        self.requests += 1
+        if self._latency:
+            time.sleep(self._latency)
+        if self._throttle_every and next(self._calls) % self._throttle_every == 0:
+            raise RateLimited(self._retry_after)
+        rnd = random.Random(segment_id)
+        distance, altitude = [], []
+        d, e = 0.0, 10.0
+        for _ in range(self._points):
+            distance.append(round(d, 1))
+            altitude.append(round(e, 1))
+            d += rnd.uniform(2, 15)
+            if rnd.random() < .8:
+                e += rnd.uniform(-.6, .7)
+        return {'distance': stream_cache.Stream(distance), 'altitude': stream_cache.Stream(altitude)}
+
+
+# 90 minutes in the same text format whatsonzwift lists intervals in
+WORKOUT = [
+    '10min from 50 to 75% FTP',
+    '6x 6min @ 100% FTP,4min @ 60% FTP',
+    '15min @ 90rpm, 70% FTP',
+    '5min @ 50% FTP',
+]
+
+WORKOUT_HTML = ('<html><body><div class="workoutlist">'
+                + ''.join(f'<div class="textbar">{text}</div>' for text in WORKOUT)
+                + '</div></body></html>')
+
+# Same workout listed in watts, as pages do once "View %FTP" is offered instead
+WATTS_WORKOUT = ['10min from 128 to 192W', '6x 6min @ 256W,4min @ 154W', '15min @ 90rpm, 179W', '5min @ 128W']
+
+
+def plan_html(workouts=24, watts=False):
+    """Stand-in for a saved whatsonzwift training plan page, with the page furniture around the workouts"""
+    texts = WATTS_WORKOUT if watts else WORKOUT
+    nav = ''.join(f'<li><a href="/workouts/plan-{i}">Plan {i}</a></li>' for i in range(200))
+    articles = ''.join(
+        f'<article class="workout" id="week-{w // 4 + 1}-day-{w % 4 + 1}"><h4>Week {w // 4 + 1}</h4>'
+        f'<p class="description">{"Some words about the workout. " * 20}</p><div class="workoutlist">'
+        + ''.join(f'<div class="textbar"><span>{t}</span></div>' for t in texts)
+        + '</div></article>' for w in range(workouts))
+    toggle = '<button>View %FTP</button>' if watts else ''
+    return f'<html><head><title>plan</title></head><body><nav><ul>{nav}</ul></nav>{toggle}{articles}</body></html>'.encode()
+
+
+class _PlanHandler(BaseHTTPRequestHandler):
+    # GET /workouts/<plan> for a plan page, /workouts/<plan>/<workout> for a workout page
+    fixture = None
+
+    def do_GET(self):
+        page = self.fixture.page(self.path)
+        if page is None:
+            status = 404
+        elif self.fixture.fail(self.path):
+            status = 503
+        else:
+            etag = f'"{hashlib.sha1(page).hexdigest()[:16]}"'
+            status = 304 if self.headers.get('If-None-Match') == etag else 200
+        self.fixture.served(status)
+
+        self.send_response(status)
+        if status == 503:
+            self.send_header('Retry-After', '0')
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(page) if status == 200 else 0))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(page)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class PlanServer(object):
+    """Local stand-in for whatsonzwift serving saved plan pages, to run `WorkoutLoader.prefetch` against
+
+    Every plan is a `plan_html` page of `plan_workouts` workouts and every workout `WORKOUT_HTML`,
+    sent with an ETag so a conditional GET for a page already fetched gets a bare 304. The first
+    `failures` requests for each page are refused with a 503. Serves from a thread on an
+    ephemeral port (see `base_url`) until closed, counting the responses by status.
+    """
+
+    def __init__(self, plan_workouts=24, failures=0):
+        self._pages = {'plan': plan_html(plan_workouts), 'workout': WORKOUT_HTML.encode()}
+        self._failures = failures
+        self._lock = threading.Lock()
+        self._failed = collections.Counter()
+        self.statuses = collections.Counter()
+        handler = type('Handler', (_PlanHandler,), {'fixture': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self._server.server_port}'
+
+    def page(self, path):
+        parts = path.strip('/').split('/')
+        if parts[0] != 'workouts' or len(parts) not in (2, 3):
+            return None
+        return self._pages['plan' if len(parts) == 2 else 'workout']
+
+    def fail(self, path):
+        with self._lock:
+            self._failed[path] += 1
+            return self._failed[path] <= self._failures
+
+    def served(self, status):
+        with self._lock:
+            self.statuses[status] += 1
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _per_call(fn, calls, repeat=5):
+    # Best of `repeat` runs, as the fastest run is the one least disturbed by everything else
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / calls
+
+
+def _rider():
+    me = physics.Rider(90, 180, 256)
+    me.set_bike(physics.BIKES['emonda'])
+    me.set_wheels(physics.WHEELS['meilensteins'])
+    return me
+
+
+def _uncached_apply_watts(rider, watts, gradient, dt, surfaces):
+    # `Rider.apply_watts` as it was before the rider cached anything, kept as the baseline
+    v = rider._v
+    fr = physics.GRAVITY * math.cos(math.atan(gradient)) * rider.mass * rider._wheels.crr(surfaces)
+    fg = physics.GRAVITY * math.sin(math.atan(gradient)) * rider.mass
+    fd = rider.cd * rider.frontal_area * (v * v) * physics.AIR_DENSITY / 2
+    power_needed = (fr + fg + fd) * v
+    rider._v = math.sqrt(v*v + 2 * (watts - power_needed) * dt / rider.mass)
+
+
+def bench_apply_watts(ticks=100000):
+    """Per tick cost of `Rider.apply_watts` with and without the cached rider configuration"""
+    surfaces = {'road': .6, 'dirt': .4}
+    cached, uncached = _rider(), _rider()
+    result = {
+        'uncached_us': _per_call(lambda: _uncached_apply_watts(uncached, 250, .03, .1, surfaces), ticks) * 1e6,
+        'cached_us': _per_call(lambda: cached.apply_watts(250, .03, .1, surfaces), ticks) * 1e6,
+    }
+    result['speedup'] = result['uncached_us'] / result['cached_us']
+    return result
+
+
+def bench_ride(lap_segments=6, points=500, repeat=3):
+    """Full `ZwiftRide` of the 90 minute workout on a synthetic route (lead in plus a ~25km lap)"""
+    client = SyntheticClient(points)
+    details = {'lead_in': [1, 2], 'lap': list(range(3, 3 + lap_segments)), 'surfaces': {'road': .8, 'dirt': .2}}
+    workout = intervals.Workout.parse(WORKOUT)
+
+    best, summary = float('inf'), None
+    for _ in range(repeat):
+        ride = zwift.ZwiftRide(_rider(), workout, route.Route('synthetic', details, client))
+        start = time.perf_counter()
+        summary = ride.summary()
+        best = min(best, time.perf_counter() - start)
+    ticks = summary.time / zwift.ZwiftRide.DT
+    return {
+        'workout_s': summary.workout_time,
+        'distance_km': summary.distance,
+        'laps': len(summary.laps),
+        'run_s': best,
+        'tick_us': best / ticks * 1e6,
+    }
+
+
+def _write_gpx(path, points):
+    rnd = random.Random(points)
+    lat, lon, ele = 46.0, 6.0, 500.0
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+        for _ in range(points):
+            f.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele></trkpt>\n')
+            lat, lon = lat + rnd.uniform(0, 1e-4), lon + rnd.uniform(-5e-5, 1e-4)
+            ele += rnd.uniform(-.5, .6)
+        f.write('</trkseg></trk></gpx>\n')
+
+
+def bench_gpx(counts=(1000, 10000, 100000)):
+    """`GpxLap` load time against the number of track points"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            path = os.path.join(tmp, f'{count}.gpx')
+            _write_gpx(path, count)
+            start = time.perf_counter()
+            lap = route.GpxLap(None, {'gpx': path})
+            elapsed = time.perf_counter() - start
+            results[str(count)] = {'load_s': elapsed, 'point_us': elapsed / count * 1e6, 'segments': len(lap)}
+    return results
+
+
+def bench_parse(calls=2000):
+    """Interval parsing on its own and scraping a whole (canned) whatsonzwift workout page"""
+    loader = workouts.WorkoutLoader(_rider(), workout_store.WorkoutStore(':memory:', legacy_path=None))
+    soup = BeautifulSoup(WORKOUT_HTML, 'html.parser')
+    return {
+        'parse_interval_us': _per_call(lambda: [intervals.parse_interval(t) for t in WORKOUT], calls) / len(WORKOUT) * 1e6,
+        'scrape_workout_us': _per_call(lambda: loader._scrape_workout(soup, False), calls // 10) * 1e6,
+        'soup_and_scrape_us': _per_call(lambda: loader._scrape_workout(BeautifulSoup(WORKOUT_HTML, 'html.parser'), False),
+                                        calls // 10) * 1e6,
+    }
+
+
+def bench_workout(calls=200):
+    """Building the 90 minute workout as a list of intervals vs a `Workout`, and target watts for every tick"""
+    workout = intervals.Workout.parse(WORKOUT)
+    ticks = np.arange(0, workout.workout_time, zwift.ZwiftRide.DT)
+    return {
+        'interval_list_us': _per_call(lambda: [i for t in WORKOUT for i in intervals.parse_interval(t).intervals()], calls) * 1e6,
+        'workout_us': _per_call(lambda: intervals.Workout.parse(WORKOUT), calls) * 1e6,
+        'intervals': len(workout),
+        'rows': len(workout.kind),
+        'power_at_tick_ns': _per_call(lambda: workout.power_at(ticks, 256), calls // 10) / len(ticks) * 1e9,
+    }
+
+
+def bench_plan_page(calls=20):
+    """Whole plan pages through the original BeautifulSoup parse vs the fast path"""
+    rider = _rider()
+    store = workout_store.WorkoutStore(':memory:', legacy_path=None)
+    soup = workouts.WorkoutLoader(rider, store, fast_parse=False)
+    fast = workouts.WorkoutLoader(rider, store)
+    results = {'parser': workouts.HTML_PARSER}
+    for name, page in (('pct', plan_html()), ('watts', plan_html(watts=True))):
+        slow_ms = _per_call(lambda: soup._parse_plan_page(page), calls) * 1e3
+        fast_ms = _per_call(lambda: fast._parse_plan_page(page), calls) * 1e3
+        results[name] = {'page_kb': len(page) / 1024, 'soup_ms': slow_ms, 'fast_ms': fast_ms, 'speedup': slow_ms / fast_ms}
+    return results
+
+
+def bench_estimate(lap_segments=6, points=500, calls=5):
+    """`SpeedTable` build/load time and the steady state estimate against the engine on the synthetic route"""
+    client = SyntheticClient(points)
+    details = {'lead_in': [1, 2], 'lap': list(range(3, 3 + lap_segments)), 'surfaces': {'road': .8, 'dirt': .2}}
+    profile = engine.RouteProfile(route.Route('synthetic', details, client))
+    workout = engine.WorkoutProfile(intervals.Workout.parse(WORKOUT))
+    rider = _rider()
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        table = physics.SpeedTable.cached(rider, tmp)
+        build_s = time.perf_counter() - start
+        physics._SPEED_TABLES.clear()
+        load_s = _per_call(lambda: (physics.SpeedTable.cached(rider, tmp), physics._SPEED_TABLES.clear()), calls)
+    exact, estimate = engine.simulate(rider, workout, profile), integrator.EstimatedRide(rider, workout, profile).summary()
+    return {
+        'table_build_s': build_s,
+        'table_load_s': load_s,
+        'table_max_error_ms': table.max_error,
+        'engine_s': _per_call(lambda: engine.simulate(rider, workout, profile), calls),
+        'estimate_s': _per_call(lambda: integrator.EstimatedRide(rider, workout, profile, table=table).summary(), calls),
+        'distance_error_m': (estimate.distance - exact.distance) * 1000,
+    }
+
+
+def bench_group(riders=50, lap_segments=6, points=500):
+    """A group of riders on the synthetic route: one `ZwiftRide` each vs one `simulate_group` pass"""
+    client = SyntheticClient(points)
+    details = {'lead_in': [1, 2], 'lap': list(range(3, 3 + lap_segments)), 'surfaces': {'road': .8, 'dirt': .2}}
+    profile = engine.RouteProfile(route.Route('synthetic', details, client))
+    workout = engine.WorkoutProfile(intervals.Workout.parse(WORKOUT))
+    rnd = random.Random(riders)
+    group = [physics.Rider(rnd.uniform(55, 100), rnd.randint(160, 195), rnd.randint(150, 350)) for _ in range(riders)]
+    for rider in group:
+        rider.set_bike(physics.BIKES[rnd.choice(list(physics.BIKES))])
+        rider.set_wheels(physics.WHEELS[rnd.choice(list(physics.WHEELS))])
+    # Rides change their rider and route as they go, so each gets its own
+    rides = [zwift.ZwiftRide(copy.deepcopy(r), workout.workout, route.Route('synthetic', details, client)) for r in group]
+    return {
+        'riders': riders,
+        'zwift_ride_s': _per_call(lambda: [ride.summary() for ride in rides], 1, 1),
+        'engine_s': _per_call(lambda: [engine.simulate(r, workout, profile) for r in group], 1, 3),
+        'group_s': _per_call(lambda: engine.simulate_group(group, workout, profile), 1, 3),
+    }
+
+
+def bench_trace(lap_segments=6, points=500, repeat=3):
+    """Exporting every tick of the 90 minute workout as a columnar trace, against the summary alone"""
+    client = SyntheticClient(points)
+    details = {'lead_in': [1, 2], 'lap': list(range(3, 3 + lap_segments)), 'surfaces': {'road': .8, 'dirt': .2}}
+    profile = engine.RouteProfile(route.Route('synthetic', details, client))
+    workout = engine.WorkoutProfile(intervals.Workout.parse(WORKOUT))
+    rider = _rider()
+    results = {'summary_s': _per_call(lambda: engine.simulate(rider, workout, profile), 1, repeat)}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, compress in (('export', False), ('export_compressed', True)):
+            path = os.path.join(tmp, f'{name}.npz')
+            results[f'{name}_s'] = _per_call(lambda: traces.export_trace(rider, workout, profile, path, compress=compress), 1, repeat)
+            results[f'{name}_kb'] = os.path.getsize(path) / 1024
+        results['rows'] = len(traces.read_trace(path, ['time'])['time'])
+    return results
+
+
+def bench_parity(lap_segments=6, points=500, lanes=engine.BATCH_MIN_LANES):
+    """Whether every kernel gives `ZwiftRide`'s lap splits, with a lead-in and with an empty one
+
+    Lap splits (and so completion) have to match exactly, distance to within rounding. The
+    batch kernel is only used from `lanes` rides, so it's given that many copies of the ride.
+    """
+    client = SyntheticClient(points)
+    workout = engine.WorkoutProfile(intervals.Workout.parse(WORKOUT))
+    rider = _rider()
+    results = {}
+    for name, lead_in in (('lead_in', [1, 2]), ('empty_lead_in', [])):
+        details = {'lead_in': lead_in, 'lap': list(range(3, 3 + lap_segments)), 'surfaces': {'road': .8, 'dirt': .2}}
+        expected = zwift.ZwiftRide(copy.deepcopy(rider), workout.workout, route.Route('synthetic', details, client)).summary()
+        profile = engine.RouteProfile(route.Route('synthetic', details, client))
+        kernels = {
+            'engine': engine.simulate(rider, workout, profile),
+            'batch': engine.simulate_batch([(rider, workout, profile)] * lanes)[0],
+            'group': engine.simulate_group([rider], workout, profile)[0],
+        }
+        results[name] = {kernel: {
+            'laps': len(summary.laps),
+            'laps_match': summary.laps == expected.laps,
+            'distance_delta_m': (summary.distance - expected.distance) * 1000,
+        } for kernel, summary in kernels.items()}
+        results[name]['zwift_ride_laps'] = len(expected.laps)
+        results[name]['match'] = all(r['laps_match'] and abs(r['distance_delta_m']) < 1e-6
+                                     for k, r in results[name].items() if k in kernels)
+    return results
+
+
+def bench_prefetch(plans=4, plan_workouts=24, failures=2, concurrency=4, backoff=.01):
+    """`WorkoutLoader.prefetch` from a `PlanServer` refusing every page `failures` times, then again unchanged
+
+    The first run has to retry its way through the 503s (backing off for at least `backoff`
+    seconds, doubling, between tries) and store every page, the second should only get 304s
+    back and leave the store as it was.
+    """
+    names = [f'plan-{i}' for i in range(plans)]
+    singles = ['other-plan.week-1-day-1']
+    pages = len(names) + len(singles)
+    store = workout_store.WorkoutStore(':memory:', legacy_path=None)
+    results = {'pages': pages}
+    with PlanServer(plan_workouts, failures) as server:
+        loader = workouts.WorkoutLoader(_rider(), store, base_url=server.base_url)
+        for run in ('first', 'unchanged'):
+            server.statuses.clear()
+            start = time.perf_counter()
+            fetched = asyncio.run(loader.prefetch(names, singles, concurrency, retries=failures, backoff=backoff))
+            results[run] = {
+                'prefetch_s': time.perf_counter() - start,
+                'results': dict(collections.Counter(fetched.values())),
+                'statuses': {str(status): n for status, n in sorted(server.statuses.items())},
+                'stored': len(store.names()),
+            }
+    first, unchanged = results['first'], results['unchanged']
+    results['retried'] = (first['results'] == {'fetched': pages} and first['statuses'] == {'200': pages, '503': pages * failures}
+                          and first['prefetch_s'] >= backoff * (2 ** failures - 1))
+
+    results['conditional_get'] = (unchanged['results'] == {'unchanged': pages} and unchanged['statuses'] == {'304': pages}
+                                  and unchanged['stored'] == first['stored'] == plans * plan_workouts + len(singles))
+    return results
+
+
+def _load_every_route(client, names, workers):
+    # Route by route (one segment at a time) with one worker, otherwise prefetching every segment first
+    fetcher = route.SegmentFetcher(client, workers)
+    if workers > 1:
+        fetcher.prefetch(names)
+    for name in names:
+        route.load_route(name, fetcher if workers > 1 else route.SegmentFetcher(client, 1))
+
+
+def bench_fetch(latency=.01, throttle_every=25, workers=route.FETCH_WORKERS):
+    """Loading every strava route through the stream cache from a slow, rate limiting strava"""
+    names = [f'{world}.{r}' for world, routes in route.route_directory().items() if world != 'comment'
+             for r, details in routes.items() if 'gpx' not in details]
+    results = {'routes': len(names)}
+    for name, n in (('sequential', 1), ('concurrent', workers)):
+        synthetic = SyntheticClient(latency=latency, throttle_every=throttle_every)
+        client = stream_cache.CachedClient(stream_cache.StreamCache(':memory:'), connect=lambda: synthetic,
+                                           limiter=stream_cache.RateLimiter(((1000, 1),)))
+        start = time.perf_counter()
+        _load_every_route(client, names, n)
+        results[name] = {'load_s': time.perf_counter() - start, 'requests': synthetic.requests}
+    results['speedup'] = results['sequential']['load_s'] / results['concurrent']['load_s']
+    return results
+
+
+# Milliseconds each entry point may take to import on top of numpy (which everything needs),
+# and the dependencies only some code paths need, which importing them mustn't pull in
+IMPORT_BUDGET_MS = 30
+ENTRY_POINTS = ('zwift', 'batch', 'solver', 'integrator', 'route', 'workouts')
+LAZY_MODULES = ('bs4', 'lxml', 'requests', 'stravalib', 'gpxpy', 'jsonpickle', 'asyncio', 'xml.etree.ElementTree', 'cProfile',
+                'argparse', 'concurrent.futures', 'hashlib')
+
+
+
+def _import_ms(module, repeat=5):
+    # Best of `repeat` fresh interpreters, run where the data files are as the CLIs would be
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {module}'], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def bench_startup():
+    """Time to import each entry point in a fresh interpreter, against `IMPORT_BUDGET_MS` on top of numpy"""
+    baseline = _import_ms('numpy')
+    results = {'numpy_ms': baseline, 'budget_ms': IMPORT_BUDGET_MS}
+    for module in ENTRY_POINTS:
+        total = _import_ms(module)
+        check = f'import sys, {module}; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+        eager = subprocess.run([sys.executable, '-c', check], check=True, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        results[module] = {
+            'import_ms': total,
+            'over_numpy_ms': total - baseline,
+            'within_budget': total - baseline <= IMPORT_BUDGET_MS and not eager,
+            'eager_imports': eager.split(',') if eager else [],
+        }
+    return results
+
+
+BENCHMARKS = {
+    'apply_watts': bench_apply_watts,
+    'ride': bench_ride,
+    'gpx': bench_gpx,
+    'parse': bench_parse,
+    'workout': bench_workout,
+    'plan_page': bench_plan_page,
+    'estimate': bench_estimate,
+    'group': bench_group,
+    'fetch': bench_fetch,
+    'prefetch': bench_prefetch,
+
+    'trace': bench_trace,
+    'parity': bench_parity,
+
+    'startup': bench_startup,
+}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(prog='ZwiftBenchmarks')
+    p.add_argument('-b', '--benchmark', action='append', choices=list(BENCHMARKS), help='benchmark to run (default: all)')
+    p.add_argument('-o', '--output', help='json file to write the results to')
+    args = p.parse_args()
+
+    # Everything runs offline against synthetic data, so results are comparable between releases
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': {name: BENCHMARKS[name]() for name in args.benchmark or BENCHMARKS},
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
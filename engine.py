@@ -0,0 +1,691 @@
+import bisect
+import collections
+import copy
+import logging
+import math
+import time
+
+import numpy as np
+
+import instrument
+import intervals
+import physics
+
+
+log = logging.getLogger(__name__)
+
+
+DT = 0.1
+
+# Below this many rides the fixed cost of each NumPy call outweighs stepping them together
+BATCH_MIN_LANES = 64
+# Riders on one route and workout from which a single `simulate_group` pass beats riding them one by one
+GROUP_MIN_RIDERS = 50
+
+
+def split_time(t):
+    m, s = divmod(t, 60)
+    return f'{m:.0f}m{s:.0f}s'
+
+
+class RouteProfile(object):
+    """Array form of a route: the lead-in segments followed by the segments of one lap
+
+    Everything about a segment that doesn't depend on the rider is precomputed here, so
+    simulating the route is just arithmetic on these arrays.
+    """
+
+    def __init__(self, route):
+        self.name = route.name
+        lead_in = list(route.lead_in)
+        lap = list(route.lap)
+        segments = lead_in + lap
+        surfaces = list(route.lead_in_surfaces()) + [route.lap_surfaces] * len(lap)
+
+        self.mixes = []
+        mix = []
+        for s in surfaces:
+            if s not in self.mixes:
+                self.mixes.append(s)
+            mix.append(self.mixes.index(s))
+
+        self.length = np.array([s.length for s in segments], dtype=float)
+        self.gain = np.array([s.elevation_gain for s in segments], dtype=float)
+        self.gradient = np.array([s.gradient for s in segments], dtype=float)
+        self.cos = np.array([math.cos(math.atan(s.gradient)) for s in segments], dtype=float)
+        self.sin = np.array([math.sin(math.atan(s.gradient)) for s in segments], dtype=float)
+        self.mix = np.array(mix, dtype=np.intp)
+
+        self.lap_start = len(lead_in)
+        self.lead_in_length = route.lead_in.length
+        self.lap_length = route.lap.length
+
+    @property
+    def has_lead_in(self):
+        return self.lap_start > 0
+
+    def __len__(self):
+        return len(self.length)
+
+    def resistance(self, rider):
+        """Rolling plus gravitational resistance (N) on every segment for this rider
+
+        For a `physics.RiderBatch` it's a segments x riders array instead.
+        """
+        crr = np.array([rider.crr(s) for s in self.mixes], dtype=float)
+        cos, sin = (self.cos, self.sin) if np.ndim(rider.mass) == 0 else (self.cos[:, None], self.sin[:, None])
+        fr = physics.GRAVITY * cos * rider.mass * crr[self.mix]
+        fg = physics.GRAVITY * sin * rider.mass
+        return fr + fg
+
+
+class WorkoutProfile(object):
+    """Tick schedule of a workout: how many `dt` steps each interval lasts for
+
+    Mirrors the tick accounting of `ZwiftRide._iterate_workout` exactly (including the
+    accumulated floating point timer) so both simulators ride the same number of ticks.
+    """
+
+    def __init__(self, workout, dt=DT):
+        self.workout = workout if isinstance(workout, intervals.Workout) else intervals.Workout.from_intervals(workout)
+        self.dt = dt
+        self.durations = self.workout.durations
+        self.workout_time = self.workout.workout_time
+
+        n = int(self.workout_time / dt) + 2 * len(self.durations) + 16
+        timer = np.concatenate(([0.0], np.cumsum(np.full(n, dt))))
+
+        ends = []
+        start, finished = 0, 0
+        for duration in self.durations.tolist():
+            k = int(np.searchsorted(timer, finished + duration, side='right'))
+            while k < len(timer) and timer[k] - finished <= duration:
+                k += 1
+            while k > start and not (timer[k - 1] - finished <= duration):
+                k -= 1
+            ends.append(k)
+            start = k
+            finished += duration
+
+        self.ends = np.array(ends, dtype=np.intp)
+        self.counts = np.diff(self.ends, prepend=0)
+        self.ticks = int(self.ends[-1]) if ends else 0
+        self.time = float(timer[self.ticks])
+
+    def watts(self, ftp):
+        return self.workout.watts(ftp).astype(float)
+
+    def power(self, ftp):
+        """Target watts for every tick of the workout"""
+        return np.repeat(self.watts(ftp), self.counts)
+
+
+class RideSummary(object):
+    """Outcome of a simulated ride: lap splits along with distance and elevation totals
+    """
+
+    def __init__(self, route, lead_in_length, lap_length, workout_time, laps, distance, climbed, time):
+        self.route = route
+        self.workout_time = workout_time
+        self.laps = laps  # list of (seconds, is_lead_in)
+        self.distance = distance / 1000
+        self.climbed = climbed
+        self.time = time
+
+        self._lead_in_length = lead_in_length
+        self._lap_length = lap_length
+        self._lead_in_active = lead_in_length > 0 and not laps
+
+        # Counters and timers of the ride, as `instrument.Metrics.as_dict`
+        self.metrics = {}
+
+    @classmethod
+    def of(cls, route, workout_time, laps, distance, climbed, time):
+        """Summary for a ride on a `RouteProfile`"""
+        return cls(route.name, route.lead_in_length, route.lap_length, workout_time, laps, distance, climbed, time)
+
+    @property
+    def completed_laps(self):
+        return sum(1 for _, is_lead_in in self.laps if not is_lead_in)
+
+    @property
+    def completed_distance(self):
+        return sum(self._lead_in_length if is_lead_in else self._lap_length for _, is_lead_in in self.laps)
+
+    @property
+    def active_lap_length(self):
+        return self._lead_in_length if self._lead_in_active else self._lap_length
+
+    @property
+    def partial_distance(self):
+        """Distance (km) ridden on the lap that was still in progress when the workout ended"""
+        return self.distance - self.completed_distance
+
+    @property
+    def remaining_distance(self):
+        """Distance (km) still needed to finish that lap"""
+        return self.active_lap_length - self.partial_distance
+
+    def as_dict(self):
+        """Plain values (for json), with a split per lap numbered as `report` numbers them"""
+        lap_number = iter(range(len(self.laps)))
+        splits = [{
+            'lap': 'lead_in' if is_lead_in else next(lap_number),
+            'time_s': t,
+            'split': split_time(t),
+            'workout_left_s': self.workout_time - t,
+        } for t, is_lead_in in self.laps]
+        return {
+            'route': self.route,
+            'workout_s': self.workout_time,
+            'laps': splits,
+            'completed_laps': self.completed_laps,
+            'lap_completion': self.partial_distance / self.active_lap_length,
+            'remaining_km': self.remaining_distance,
+            'distance_km': self.distance,
+            'climbed_m': self.climbed,
+            'time_s': self.time,
+        }
+
+    def report(self, level=logging.INFO):
+        lap_number = iter(range(len(self.laps)))
+        for t, is_lead_in in self.laps:
+            name = 'Lead-In' if is_lead_in else f'Lap {next(lap_number)}'
+            log.log(level, '%s completed in %s (with %.2fs left in workout)', name, split_time(t), self.workout_time - t)
+
+        distance, length = self.partial_distance, self.active_lap_length
+        log.log(level, 'Workout completed with current lap only %.2f%% complete (%.2fkm out of %.2fkm)',
+                100 * distance / length, distance, length)
+        log.log(level, 'In total, workout would travel %.2fkm and climb %.2fm', self.distance, self.climbed)
+
+
+def ride_counters(lap_segments, laps, i, intervals, ticks=None):
+    """What a ride got through, going by where it ended up
+
+    `i` is the segment the ride is on (the lead-in's first being 0) and `laps` its lap reports,
+    so every lap reported took another `lap_segments` segments.
+    """
+    completed = sum(1 for _, is_lead_in in laps if not is_lead_in)
+    counters = {'intervals': intervals, 'segments': i + completed * lap_segments, 'laps': len(laps)}
+    if ticks is not None:
+        counters['ticks'] = ticks
+    return {'counters': counters}
+
+
+def _empty_lap(route):
+    return Exception(f'Route {route.name} has no lap to continue riding on')
+
+
+class RideState(object):
+    """Where `_integrate` (or a `zwift.ZwiftRide`) is within a ride, so the ride can be stopped
+    and carried on exactly, by either of them
+
+    `paused` is set when the ride stopped on reaching segment `i` (see `pause_at`), before any
+    lap that completes by reaching it is recorded.
+    """
+
+    def __init__(self, velocity=0):
+        self.v, self.d, self.t, self.mark = velocity, 0.0, 0, 0
+        self.tick, self.i = 0, 0
+        self.traveled, self.climbed, self.laps = 0, 0, []
+        self.paused = False
+
+    def copy(self):
+        state = copy.copy(self)
+        state.laps = list(self.laps)
+        return state
+
+
+def _integrate(rider, workout, route, every, state=None, pause_at=None, segment_index=False):
+    """Scalar kernel for a single ride, yielding the traced ticks of every interval as one chunk
+
+    A tick is traced every `every` seconds (every tick for 0, none at all for None), with the
+    index of the segment it was ridden on appended when `segment_index` is set. The ride
+    carries on from `state` if given, which is kept up to date after every chunk. With `pause_at`
+    the ride stops (returning None) as soon as it reaches that segment index for the first time.
+
+    The velocity recurrence is sequential in time, so a single ride can't be vectorized;
+    instead every per-tick lookup is hoisted out of the loop and only plain float math remains.
+    """
+    dt = workout.dt
+    mass = rider.mass
+    cda = rider.cda
+    resist = route.resistance(rider).tolist()
+    lengths = route.length.tolist()
+    gains = route.gain.tolist()
+    n = len(lengths)
+    if n == 0:
+        raise _empty_lap(route)
+
+    state = state if state is not None else RideState(rider.velocity)
+    first_tick = state.tick
+    v, d, t, mark = state.v, state.d, state.t, state.mark
+    climbed, traveled, laps, i = state.climbed, state.traveled, state.laps, state.i
+    if state.paused:
+        state.paused = False
+        if i == n or i == route.lap_start:
+            laps.append((t, route.has_lead_in and not laps))
+            i = route.lap_start
+            if i == n:
+                raise _empty_lap(route)
+    seg_end, seg_resist = traveled + lengths[i], resist[i]
+    trace = every is not None
+
+    ends = workout.ends.tolist()
+    first = bisect.bisect_right(ends, state.tick)
+    tick = state.tick
+    for watts, end in zip(workout.watts(rider.ftp).tolist()[first:], ends[first:]):
+        chunk = [] if trace else None
+        for tick in range(tick, end):
+            while not (seg_end > d):
+                traveled += lengths[i]
+                climbed += gains[i]
+                i += 1
+                if i == pause_at:
+                    state.v, state.d, state.t, state.mark, state.tick = v, d, t, mark, tick
+                    state.climbed, state.traveled, state.i, state.paused = climbed, traveled, i, True
+                    yield chunk
+                    return None
+                if i == n or i == route.lap_start:
+                    laps.append((t, route.has_lead_in and not laps))
+                    i = route.lap_start
+                    if i == n:
+                        raise _empty_lap(route)
+                seg_end, seg_resist = traveled + lengths[i], resist[i]
+
+            old_v = v
+            d += v * dt
+            p = (seg_resist + cda * (v*v) * physics.AIR_DENSITY / 2) * v
+            v = math.sqrt(v*v + 2 * (watts - p) * dt / mass)
+            if trace and t >= mark:
+                chunk.append((old_v, d / 1000, climbed, t, i) if segment_index else (old_v, d / 1000, climbed, t))
+                mark += every
+            t += dt
+        tick = end
+        state.v, state.d, state.t, state.mark, state.tick = v, d, t, mark, tick
+        state.climbed, state.traveled, state.i = climbed, traveled, i
+        yield chunk
+
+    summary = RideSummary.of(route, workout.workout_time, laps, d, climbed, t)
+    summary.metrics = ride_counters(n - route.lap_start, laps, i, len(ends), tick - first_tick)
+    return summary
+
+
+class Checkpoints(object):
+    """LRU cache of ride states at the end of a lead-in, so a lead-in shared by several routes is
+    only simulated once per rider and workout
+
+    Routes list the same lead-in segments over and over, and up to the end of the lead-in the
+    ride doesn't depend on anything else about the route. States are keyed on everything that
+    goes into stepping the lead-in: the rider's mass, drag and starting speed, the workout's
+    watts and tick schedule and the lead-in's segments along with their resistance (which
+    covers the surfaces and wheels). A workout that's over before the lead-in ends leaves its
+    final state instead.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self._states = collections.OrderedDict()
+        self.hits, self.misses, self.skipped_ticks = 0, 0, 0
+
+    @staticmethod
+    def key(rider, workout, route):
+        n = route.lap_start
+        return (rider.mass, rider.cda, rider.velocity, workout.dt,
+                workout.watts(rider.ftp).tobytes(), workout.ends.tobytes(),
+                route.length[:n].tobytes(), route.gain[:n].tobytes(), route.resistance(rider)[:n].tobytes())
+
+    def lead_in(self, rider, workout, route):
+        """Copy of the state the ride is in as the lead-in ends (None for a route without one)
+
+        The state is `paused` on reaching the lap, ready to be carried on by `_integrate`, unless
+        the workout finished first.
+        """
+        if not route.has_lead_in:
+            return None
+        key = self.key(rider, workout, route)
+        state = self._states.get(key)
+        if state is not None:
+            self._states.move_to_end(key)
+            self.hits += 1
+            self.skipped_ticks += state.tick
+            return state.copy()
+
+        self.misses += 1
+        state = RideState(rider.velocity)
+        for _ in _integrate(rider, workout, route, None, state, pause_at=route.lap_start):
+            pass
+        self._states[key] = state
+        if len(self._states) > self.size:
+            self._states.popitem(last=False)
+        return state.copy()
+
+    def clear(self):
+        self._states.clear()
+
+
+def _profiles(workout, route, dt):
+    if not isinstance(workout, WorkoutProfile):
+        workout = WorkoutProfile(workout, dt)
+    if not isinstance(route, RouteProfile):
+        route = RouteProfile(route)
+    return workout, route
+
+
+def _shared_profiles(rides, dt):
+    # Build each distinct workout/route profile once for the whole batch
+    workouts, routes = {}, {}
+    for rider, workout, route in rides:
+        if id(workout) not in workouts:
+            workouts[id(workout)] = workout if isinstance(workout, WorkoutProfile) else WorkoutProfile(workout, dt)
+        if id(route) not in routes:
+            routes[id(route)] = route if isinstance(route, RouteProfile) else RouteProfile(route)
+        yield rider, workouts[id(workout)], routes[id(route)]
+
+
+class FastRide(object):
+    """Array-backed counterpart of `zwift.ZwiftRide`
+
+    Yields the same `(velocity, distance, climbed, time)` tuples when iterated (or every so
+    many seconds through `trace`), or just the final `RideSummary` through `summary()`
+    without producing any per-tick output. Summaries can share lead-ins with other rides
+    through a `Checkpoints` cache.
+    """
+
+    _kernel = staticmethod(_integrate)
+
+    def __init__(self, rider, workout, route, dt=DT, checkpoints=None):
+        self._rider = rider
+        self._workout, self._route = _profiles(workout, route, dt)
+        self._checkpoints = checkpoints
+        self._summary = None
+        self._metrics = instrument.Metrics()
+
+    def _run(self, every, **resume):
+        # Every run rides the whole ride again, so the metrics are only ever those of the latest.
+        # Only the time spent in the kernel counts, not whatever is done with the trace in between.
+        self._metrics = instrument.Metrics()
+        if resume.get('state') is not None:
+            self._metrics.count('checkpoint_ticks', resume['state'].tick)
+        it = self._kernel(self._rider, self._workout, self._route, every, **resume)
+        elapsed = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(it)
+                except StopIteration as done:
+                    self._summary = done.value
+                    self._metrics.merge(self._summary.metrics)
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield chunk
+        finally:
+            self._metrics.add_time('simulate', elapsed)
+            if self._summary is not None:
+                self._summary.metrics = self.metrics
+
+    @property
+    def metrics(self):
+        """Counters and timers of the ride so far, as `instrument.Metrics.as_dict`"""
+        return self._metrics.as_dict()
+
+    def summary(self):
+        """Final `RideSummary`, carrying on from the end of the lead-in when `checkpoints` has it"""
+        resume = {}
+        if self._checkpoints is not None:
+            resume['state'] = self._checkpoints.lead_in(self._rider, self._workout, self._route)
+        for _ in self._run(None, **resume):
+            pass
+        return self._summary
+
+    def trace(self, every=0):
+        for chunk in self._run(every):
+            yield from chunk
+        self._summary.report()
+
+    def __iter__(self):
+        return self.trace()
+
+
+def simulate(rider, workout, route, dt=DT, checkpoints=None):
+    return FastRide(rider, workout, route, dt, checkpoints).summary()
+
+
+def simplification_report(rider, workout, route, tolerance):
+    """How much `route.simplified(tolerance)` shrinks the route and how much it moves the estimate"""
+    simplified = route.simplified(tolerance)
+    before, after = simulate(rider, workout, route), simulate(rider, workout, simplified)
+    splits = [b - a for (a, _), (b, _) in zip(before.laps, after.laps)]
+    count = lambda r: len(r.lead_in) + len(r.lap)
+    return {
+        'route': route.name,
+        'tolerance_m': tolerance,
+        'segments': count(route),
+        'simplified_segments': count(simplified),
+        'reduction': 1 - count(simplified) / max(count(route), 1),
+        'distance_delta_m': (after.distance - before.distance) * 1000,
+        'climbed_delta_m': after.climbed - before.climbed,
+        'max_split_delta_s': max((abs(s) for s in splits), default=0),
+        'laps_delta': len(after.laps) - len(before.laps),
+    }
+
+
+@np.errstate(invalid='ignore')
+def simulate_batch(rides, dt=DT, checkpoints=None):
+    """Simulate many `(rider, workout, route)` combinations at once
+
+    Every ride is a lane in a set of NumPy arrays which are all stepped together, so the
+    per-tick interpreter overhead is paid once per tick instead of once per ride per tick.
+    Workouts and routes may be given as profiles to share them across calls. Batches too small
+    to step together are simulated one by one, sharing lead-ins through `checkpoints`; lanes
+    stepped together gain little from skipping ticks, so they always ride the lead-in.
+
+    A rider stalling (too slow to get up a climb) raises `ValueError` either way, as in `_integrate`.
+    """
+    lanes = list(_shared_profiles(rides, dt))
+    if len(lanes) < BATCH_MIN_LANES:
+        return [FastRide(*ride, dt, checkpoints).summary() for ride in lanes]
+
+    # Flatten the routes into one set of segment arrays with per lane offsets
+    offsets, resist, lengths, gains = [], [], [], []
+    base = 0
+    for rider, _, route in lanes:
+        if len(route) == 0 or route.lap_start == len(route):
+            raise _empty_lap(route)
+        offsets.append(base)
+        resist.append(route.resistance(rider))
+        lengths.append(route.length)
+        gains.append(route.gain)
+        base += len(route)
+    resist, lengths, gains = np.concatenate(resist), np.concatenate(lengths), np.concatenate(gains)
+    offsets = np.array(offsets, dtype=np.intp)
+    seg_stop = offsets + np.array([len(r) for _, _, r in lanes], dtype=np.intp)
+    lap_start = offsets + np.array([r.lap_start for _, _, r in lanes], dtype=np.intp)
+
+    # Same for the workouts, with the interval ends as absolute tick numbers
+    int_offsets, watts, int_ends = [], [], []
+    base = 0
+    for rider, workout, _ in lanes:
+        int_offsets.append(base)
+        watts.append(workout.watts(rider.ftp))
+        int_ends.append(workout.ends)
+        base += len(workout.durations)
+    watts, int_ends = np.concatenate(watts), np.concatenate(int_ends)
+
+    n_lanes = len(lanes)
+    mass = np.array([r.mass for r, _, _ in lanes], dtype=float)
+    cda = np.array([r.cda for r, _, _ in lanes], dtype=float)
+    ticks = np.array([w.ticks for _, w, _ in lanes], dtype=np.intp)
+
+    lane = np.arange(n_lanes)
+    v = np.array([r.velocity for r, _, _ in lanes], dtype=float)
+    d = np.zeros(n_lanes)
+    climbed = np.zeros(n_lanes)
+    traveled = np.zeros(n_lanes)
+    seg = offsets.copy()
+    seg_end = traveled + lengths[seg]
+    seg_resist = resist[seg]
+    # Padding the interval arrays with a sentinel keeps the lookups below in bounds for
+    # lanes whose workout is empty (they finish on the very first tick anyway)
+    watts, int_ends = np.append(watts, 0), np.append(int_ends, 0)
+    ptr = np.array(int_offsets, dtype=np.intp)
+    p_watts, p_end = watts[ptr], int_ends[ptr]
+
+    laps = [[] for _ in range(n_lanes)]
+    results = [None] * n_lanes
+    has_lead_in = [r.has_lead_in for _, _, r in lanes]
+
+    t, tick = 0, 0
+    next_done, next_interval = ticks.min(), p_end.min()
+    while len(lane):
+        if tick >= next_done:
+            done = ticks[lane] <= tick
+            if np.isnan(v[done]).any():
+                raise ValueError('math domain error')
+            for k in np.flatnonzero(done):
+                rider, workout, route = lanes[lane[k]]
+                summary = RideSummary.of(route, workout.workout_time, laps[lane[k]], d[k], climbed[k], t)
+                summary.metrics = ride_counters(len(route) - route.lap_start, laps[lane[k]], int(seg[k] - offsets[lane[k]]),
+                                                len(workout.durations), workout.ticks)
+                results[lane[k]] = summary
+            keep = ~done
+            lane, v, d, climbed, traveled = lane[keep], v[keep], d[keep], climbed[keep], traveled[keep]
+            seg, seg_end, seg_resist = seg[keep], seg_end[keep], seg_resist[keep]
+            ptr, p_watts, p_end = ptr[keep], p_watts[keep], p_end[keep]
+            mass, cda = mass[keep], cda[keep]
+            if not len(lane):
+                break
+            next_done, next_interval = ticks[lane].min(), p_end.min()
+
+        if tick >= next_interval:
+            nxt = p_end <= tick
+            while nxt.any():
+                ptr[nxt] += 1
+                p_watts[nxt] = watts[ptr[nxt]]
+                p_end[nxt] = int_ends[ptr[nxt]]
+                nxt = p_end <= tick
+            next_interval = p_end.min()
+
+        adv = seg_end <= d
+        while adv.any():
+            k = np.flatnonzero(adv)
+            traveled[k] += lengths[seg[k]]
+            climbed[k] += gains[seg[k]]
+            seg[k] += 1
+            lapped = k[(seg[k] == seg_stop[lane[k]]) | (seg[k] == lap_start[lane[k]])]
+            for w in lapped:
+                laps[lane[w]].append((t, has_lead_in[lane[w]] and not laps[lane[w]]))
+            seg[lapped] = lap_start[lane[lapped]]
+            seg_end[k] = traveled[k] + lengths[seg[k]]
+            seg_resist[k] = resist[seg[k]]
+            adv = seg_end <= d
+
+        vv = v * v
+        d += v * dt
+        p = (seg_resist + cda * vv * physics.AIR_DENSITY / 2) * v
+        # Not clamped, so a lane that stalls carries NaN from here on and fails once it finishes,
+        # rather than carrying on where `math.sqrt` fails the same ride in `_integrate`
+        v = np.sqrt(vv + 2 * (p_watts - p) * dt / mass)
+        t += dt
+        tick += 1
+
+    return results
+
+
+class _Course(object):
+    # Segments in the order a group rides them (the lead-in, then lap after lap) for as many laps
+    # as the group has got to so far. `ends[c]` is where the `c`th of them ends and `climbs[c]` the
+    # climbing done before it, summed up in the same order `_integrate` adds them up.
+    def __init__(self, route):
+        self.route = route
+        self.lap = np.arange(route.lap_start, len(route), dtype=np.intp)
+        self.seq = np.arange(len(route), dtype=np.intp)
+        self.ends = np.add.accumulate(route.length)
+        self.climbs = np.concatenate(([0.0], np.add.accumulate(route.gain)))
+        self.extend()
+
+    def extend(self):
+        """Double the laps covered"""
+        more = np.tile(self.lap, max(1, (len(self.seq) - self.route.lap_start) // len(self.lap)))
+        self.seq = np.concatenate((self.seq, more))
+        self.ends = np.concatenate((self.ends, np.add.accumulate(np.concatenate((self.ends[-1:], self.route.length[more])))[1:]))
+        self.climbs = np.concatenate((self.climbs, np.add.accumulate(np.concatenate((self.climbs[-1:], self.route.gain[more])))[1:]))
+
+
+@np.errstate(invalid='ignore')
+def simulate_group(riders, workout, route, dt=DT):
+    """Ride one workout on one route with a whole group of riders at once
+
+    `riders` is a list of `physics.Rider`s or a `physics.RiderBatch` (which is left at the
+    riders' final speeds). As everyone rides the same ticks over the same segments, where each
+    rider is on the route comes down to how many segments it has ridden, and a single NumPy
+    pass covers the whole group. That's several times cheaper than a `ZwiftRide` each, and
+    overtakes `simulate` per rider somewhere past 50 riders. Returns a `RideSummary` (with its
+    lap splits) per rider, identical to simulating each rider on its own (and failing the
+    same way if one stalls).
+    """
+    workout, route = _profiles(workout, route, dt)
+    batch = riders if isinstance(riders, physics.RiderBatch) else physics.RiderBatch(riders)
+    if len(route) == 0 or route.lap_start == len(route):
+        raise _empty_lap(route)
+    if not len(batch):
+        return []
+
+    course = _Course(route)
+    resist = route.resistance(batch)
+    rows = np.arange(len(batch))
+    ridden = np.zeros(len(batch), dtype=np.intp)
+    seg_end, seg_resist = course.ends[ridden], resist[0]
+    d = np.zeros(len(batch))
+
+    # Segments ridden by the time each rider completes its next lap (or the lead-in), and the
+    # soonest of those
+    next_lap = np.full(len(batch), route.lap_start or len(course.lap), dtype=np.intp)
+    lap_due = int(next_lap[0])
+    laps = [[] for _ in rows]
+
+    watts = np.array([workout.watts(r.ftp) for r in batch.riders]).reshape(len(batch), -1).T
+    t, tick = 0, 0
+    for p_watts, end in zip(watts, workout.ends.tolist()):
+        for tick in range(tick, end):
+            adv = seg_end <= d
+            if adv.any():
+                while True:
+                    ridden += adv
+                    seg_end = course.ends[ridden]
+                    adv = seg_end <= d
+                    if not adv.any():
+                        break
+                seg_resist = resist[course.seq[ridden], rows]
+                if ridden.max() >= lap_due:
+                    for r in np.flatnonzero(ridden >= next_lap).tolist():
+                        laps[r].append((t, route.has_lead_in and not laps[r]))
+                        next_lap[r] += len(course.lap)
+                    lap_due = int(next_lap.min())
+                    # Keep a lap ahead of the leader, so nobody can ride off the end before lapping again
+                    while ridden.max() + len(course.lap) >= len(course.ends):
+                        course.extend()
+
+            d += batch.velocity * dt
+            batch.apply_watts(p_watts, seg_resist, dt)
+            t += dt
+        tick = end
+
+    if np.isnan(batch.velocity).any():
+        raise ValueError('math domain error')
+    climbed = course.climbs[ridden]
+    summaries = []
+    for r, i in zip(rows.tolist(), course.seq[ridden].tolist()):
+        summary = RideSummary.of(route, workout.workout_time, laps[r], d[r], climbed[r], t)
+        summary.metrics = ride_counters(len(course.lap), laps[r], i, len(workout.durations), workout.ticks)
+        summaries.append(summary)
+    return summaries
+
+
+def simulate_riders(riders, workout, route, dt=DT, checkpoints=None):
+    """A `RideSummary` per rider on one workout and route, as one `simulate_group` pass for big enough groups"""
+    if len(riders) >= GROUP_MIN_RIDERS:
+        return simulate_group(riders, workout, route, dt)
+    return simulate_batch([(r, workout, route) for r in riders], dt, checkpoints)
@@ -0,0 +1,132 @@
+import collections
+import contextlib
+import functools
+import io
+import json
+import sys
+import threading
+import time
+
+
+class Metrics(object):
+    """Counters and wall-time timers, kept as plain values so they add up across rides and processes
+
+    `as_dict` is the form handed around (on `RideSummary.metrics`, back from batch workers, or
+    dumped as json): `{'counters': {name: n}, 'timers': {name: {'calls': n, 'seconds': s}}}`.
+    """
+
+    def __init__(self, metrics=None):
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timers = {}
+        if metrics:
+            self.merge(metrics)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def merge(self, other):
+        """Add in another `Metrics` or its `as_dict`"""
+        other = other.as_dict() if isinstance(other, Metrics) else other
+        for name, n in other.get('counters', {}).items():
+            self.count(name, n)
+        for name, timer in other.get('timers', {}).items():
+            self.add_time(name, timer['seconds'], timer['calls'])
+        return self
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.timers.items()},
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+# Everything that happens outside of a ride (route and workout loading) is recorded here
+METRICS = Metrics()
+
+
+def timed(name):
+    """Decorator recording every call's wall time in `METRICS` under `name`"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+@contextlib.contextmanager
+def profiled(profiler=None, path=None, top=25, stream=None):
+    """Profile the block with `cprofile` or `tracemalloc` (or nothing for None) and print a report
+
+    The report is the `top` functions by cumulative time or lines by allocated memory. With
+    `path` the raw profile (pstats file or tracemalloc snapshot) is saved there as well.
+    """
+    stream = stream or sys.stdout
+    if profiler is None:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise Exception(f'Unknown profiler {profiler}, expected one of {", ".join(PROFILERS)}')
+
+    # Imported here as they're only needed when profiling
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if path:
+                profile.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(top)
+            print(out.getvalue(), file=stream)
+        return
+
+    import tracemalloc
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        if path:
+            snapshot.dump(path)
+        print(f'Memory: {current / 1024:.1f}KiB still allocated, {peak / 1024:.1f}KiB at peak', file=stream)
+        for stat in snapshot.statistics('lineno')[:top]:
+            print(stat, file=stream)
@@ -0,0 +1,362 @@
+import math
+import time
+
+import numpy as np
+
+import engine
+import physics
+
+
+# Once within this fraction of terminal velocity the rider is treated as being at steady state,
+# where the linearised motion has a closed form and the regime can be crossed in one jump
+STEADY_TOL = 1e-2
+
+# Error allowed per second of adaptive step in both v**2 (m**2/s**2) and distance (m)
+STEP_TOL = 1e-3
+
+
+def _steady(v, vstar, lam, tau):
+    """Position and velocity after `tau` seconds of exponential convergence to `vstar`"""
+    decay = math.exp(-lam * tau)
+    return vstar * tau + (v - vstar) * (1 - decay) / lam, vstar + (v - vstar) * decay
+
+
+def _steady_crossing(v, vstar, lam, length):
+    # x(tau) is increasing and almost linear, so newton from the steady state guess converges fast
+    tau = length / vstar
+    for _ in range(50):
+        x, u = _steady(v, vstar, lam, tau)
+        step = (x - length) / u
+        tau -= step
+        if abs(step) < 1e-12 * (1 + tau):
+            break
+    return tau
+
+
+class _Regime(object):
+    """Constant power on a constant gradient: `m*v*dv/dt = watts - resistance*v - drag*v**3`"""
+
+    def __init__(self, watts, resistance, drag, mass):
+        self.watts, self.resistance, self.drag, self.mass = watts, resistance, drag, mass
+        self.vstar = physics.terminal_velocity(watts, resistance, drag)
+        if self.vstar > 0:
+            self.lam = (resistance + 3 * drag * self.vstar * self.vstar) / (mass * self.vstar)
+
+    def _ds(self, s):
+        # Integrating v**2 rather than v keeps the equation regular when starting from a standstill
+        v = math.sqrt(s) if s > 0 else 0
+        return 2 * (self.watts - (self.resistance + self.drag * v * v) * v) / self.mass, v
+
+    def _step(self, s, h):
+        # Bogacki-Shampine 3(2) step returning the new (v**2, distance) along with error estimates
+        k1, v1 = self._ds(s)
+        k2, v2 = self._ds(s + h * k1 / 2)
+        k3, v3 = self._ds(s + 3 * h * k2 / 4)
+        s_new = max(s + h * (2 * k1 + 3 * k2 + 4 * k3) / 9, 0)
+        x_new = h * (2 * v1 + 3 * v2 + 4 * v3) / 9
+        k4, v4 = self._ds(s_new)
+        err_s = h * (-5 * k1 / 72 + k2 / 12 + k3 / 9 - k4 / 8)
+        err_x = h * (-5 * v1 / 72 + v2 / 12 + v3 / 9 - v4 / 8)
+        return s_new, x_new, v4, max(abs(err_s), abs(err_x))
+
+    def advance(self, v, duration, length, h):
+        """Ride until `duration` seconds pass or `length` metres are covered, whichever is first
+
+        Returns the time taken, distance covered, final velocity, next step size and whether
+        the distance boundary was the one reached.
+        """
+        s, elapsed, covered = v * v, 0, 0
+        while True:
+            v = math.sqrt(s)
+            if self.vstar > 0 and abs(v - self.vstar) <= STEADY_TOL * self.vstar:
+                rem_t, rem_x = duration - elapsed, length - covered
+                x, u = _steady(v, self.vstar, self.lam, rem_t)
+                if x < rem_x:
+                    return duration, covered + x, u, h, False
+                tau = _steady_crossing(v, self.vstar, self.lam, rem_x)
+                return elapsed + tau, length, _steady(v, self.vstar, self.lam, tau)[1], h, True
+
+            # Aim just past the end of the segment so the crossing is usually found in one step.
+            # `h` itself only tracks the step size the error control allows.
+            step = min(h, duration - elapsed)
+            if v > 0:
+                step = min(step, 1.25 * (length - covered) / v)
+            s_new, dx, v_new, err = self._step(s, step)
+            if err > STEP_TOL * step and step > 1e-6:
+                h = step * max(0.2, 0.9 * (STEP_TOL * step / err) ** (1 / 2))
+                continue
+
+            if covered + dx >= length:
+                # Locate the crossing on the cubic hermite through the step, then redo the partial step
+                rem = length - covered
+                theta = rem / dx if dx > 0 else 1
+                for _ in range(30):
+                    t2, t3 = theta * theta, theta * theta * theta
+                    x = (-2 * t3 + 3 * t2) * dx + (t3 - 2 * t2 + theta) * step * v + (t3 - t2) * step * v_new
+                    dxdt = (-6 * t2 + 6 * theta) * dx + (3 * t2 - 4 * theta + 1) * step * v + (3 * t2 - 2 * theta) * step * v_new
+                    if dxdt <= 0:
+                        break
+                    delta = (x - rem) / dxdt
+                    theta = min(1, max(0, theta - delta))
+                    if abs(delta) < 1e-12:
+                        break
+                s_new = self._step(s, theta * step)[0]
+                return elapsed + theta * step, length, math.sqrt(s_new), h, True
+
+            s, elapsed, covered = s_new, elapsed + step, covered + dx
+            if elapsed >= duration:
+                return duration, covered, math.sqrt(s), h, False
+            if err < STEP_TOL * step / 10 and step == h:
+                h *= min(5, 0.9 * (STEP_TOL * step / max(err, 1e-16)) ** (1 / 2))
+
+
+def _integrate(rider, workout, route, every):
+    """Event driven kernel: every step ends exactly on an interval, segment or lap boundary
+
+    Boundaries are traced at most every `every` seconds (all of them for 0, none for None).
+    """
+    mass = rider.mass
+    drag = rider.cda * physics.AIR_DENSITY / 2
+    resist = route.resistance(rider).tolist()
+    lengths = route.length.tolist()
+    gains = route.gain.tolist()
+    n = len(lengths)
+    if n == 0:
+        raise engine._empty_lap(route)
+
+    v, d, t, h, mark = rider.velocity, 0.0, 0.0, 1.0, 0
+    trace = every is not None
+    climbed, traveled, laps = 0, 0, []
+    i = 0
+    seg_end = traveled + lengths[0]
+
+    finished = 0
+    for watts, duration in zip(workout.watts(rider.ftp).tolist(), workout.durations.tolist()):
+        finished += duration
+        regime = None
+        chunk = [] if trace else None
+        while t < finished:
+            while not (seg_end > d):
+                traveled += lengths[i]
+                climbed += gains[i]
+                i += 1
+                if i == n or i == route.lap_start:
+                    laps.append((t, route.has_lead_in and not laps))
+                    i = route.lap_start
+                    if i == n:
+                        raise engine._empty_lap(route)
+                seg_end = traveled + lengths[i]
+                regime = None
+
+            if regime is None:
+                regime = _Regime(watts, resist[i], drag, mass)
+            tau, dx, v, h, crossed = regime.advance(v, finished - t, seg_end - d, h)
+            t = finished if not crossed else t + tau
+            d = seg_end if crossed else d + dx
+            if trace and t >= mark:
+                chunk.append((v, d / 1000, climbed, t))
+                # Steps can jump several `every`s at once, so the next mark is counted from here
+                mark = t + every
+        yield chunk
+
+    summary = engine.RideSummary.of(route, workout.workout_time, laps, d, climbed, t)
+    summary.metrics = engine.ride_counters(n - route.lap_start, laps, i, len(workout.durations))
+    return summary
+
+
+class EventRide(engine.FastRide):
+    """Simulates a ride by jumping between boundaries instead of stepping a fixed `DT`
+
+    Each (segment, interval) pair is a constant power, constant gradient regime. Transients
+    are integrated with an adaptive step and steady state is crossed in closed form, so the
+    number of steps scales with the number of boundaries rather than the ride duration.
+    Iterating yields one `(velocity, distance, climbed, time)` tuple per boundary.
+    """
+
+    _kernel = staticmethod(_integrate)
+
+
+def _trailing_mean(route, values, window):
+    """Mean of a per segment value over the `window` metres ridden up to the end of each segment
+
+    Laps are ridden back to back, so a route without a lead-in looks back onto the end of its
+    lap (one with a lead-in onto the lead-in, and the start of the ride onto nothing).
+    """
+    lengths = route.length
+    pad = 0 if route.has_lead_in else int(window // max(lengths.sum(), 1e-9)) + 1
+    lengths, values = np.tile(lengths, pad + 1), np.tile(values, pad + 1)
+    x = np.concatenate(([0], np.cumsum(lengths)))
+    area = np.concatenate(([0], np.cumsum(values * lengths)))
+    starts = np.maximum(x[1:] - window, 0)
+    k = np.searchsorted(x, starts, side='right') - 1
+    mean = (area[1:] - area[k] - values[k] * (starts - x[k])) / np.maximum(x[1:] - starts, 1e-9)
+    return mean[len(mean) - len(route):]
+
+
+def _estimate(rider, workout, route, every, table=None):
+    """Steady state kernel: the rider holds each regime's steady state speed, nothing is integrated
+
+    Speeds come from the rider's `physics.SpeedTable`, so a whole interval is a lookup and a
+    cumulative sum over the route's segments. Inertia is accounted for through the table's
+    time constants instead: the rider carries speed over rises and dips, so resistance is
+    averaged over the distance a first order lag looks back (twice the distance ridden in one
+    time constant, at FTP on the lap's average resistance), and the ride trails the steady
+    state one by the time constant it starts with. That trades accuracy for speed; see
+    `compare`. Boundaries are traced once per interval.
+    """
+    table = table if table is not None else physics.SpeedTable.cached(rider)
+    lengths, gains = route.length, route.gain
+    n, lap_start = len(lengths), route.lap_start
+    if n == 0 or lap_start == n:
+        raise engine._empty_lap(route)
+
+    resist = route.resistance(rider)
+    lap_resist = float(np.average(resist[lap_start:], weights=lengths[lap_start:])) if lengths[lap_start:].sum() else 0
+    vstar, constant = (float(a[0]) for a in table.lookup(rider.ftp, [lap_resist]))
+    resist = _trailing_mean(route, resist, 2 * vstar * constant)
+
+    watts, durations = workout.watts(rider.ftp).tolist(), workout.durations.tolist()
+    delay = 0
+    if watts:
+        vstar, constant = (float(a[0]) for a in table.lookup(watts[0], resist[:1]))
+        delay = max(constant * (1 - rider.velocity / vstar), 0)
+    budget = max(workout.workout_time - delay, 0)
+
+    along, regimes = table.along(resist), {}
+    i, into, d, t, v, climbed, laps = 0, 0.0, 0.0, 0.0, rider.velocity, 0, []
+    trace = every is not None
+    for w, duration in zip(watts, durations):
+        left = min(duration, budget - t)
+        if w not in regimes:
+            speeds = along(w)
+            regimes[w] = speeds, lengths / speeds
+        speeds, times = regimes[w]
+        while left > 0:
+            rest = (lengths[i] - into) / speeds[i]
+            if rest > left:
+                into += left * speeds[i]
+                d, t, left = d + left * speeds[i], t + left, 0
+                break
+            d, t, left = d + lengths[i] - into, t + rest, left - rest
+            climbed += gains[i]
+            into, i = 0.0, i + 1
+            if i == n or i == lap_start:
+                laps.append((float(t + delay), route.has_lead_in and not laps))
+                i = lap_start
+
+            # Whole segments the rest of the interval covers, up to the end of the lead-in or lap
+            end = lap_start if i < lap_start else n
+            elapsed = np.cumsum(times[i:end])
+            k = int(np.searchsorted(elapsed, left, side='right'))
+            if k:
+                d, t, left = d + lengths[i:i + k].sum(), t + elapsed[k - 1], left - elapsed[k - 1]
+                climbed += gains[i:i + k].sum()
+                i += k
+                if i == end:
+                    laps.append((float(t + delay), route.has_lead_in and not laps))
+                    i = lap_start
+        v = float(speeds[i])
+        yield [(v, float(d) / 1000, float(climbed), float(t + delay))] if trace else None
+
+    summary = engine.RideSummary.of(route, workout.workout_time, laps, float(d), float(climbed), float(t + delay))
+    summary.metrics = engine.ride_counters(n - lap_start, laps, i, len(durations))
+    return summary
+
+
+class EstimatedRide(engine.FastRide):
+    """Near instant, approximate ride through `_estimate` for ranking routes and coarse planning
+
+    Iterating yields one `(velocity, distance, climbed, time)` tuple per interval. The rider's
+    `physics.SpeedTable` is looked up (and built the first time) unless one is given.
+    """
+
+    _kernel = staticmethod(_estimate)
+
+    def __init__(self, rider, workout, route, dt=engine.DT, table=None):
+        super().__init__(rider, workout, route, dt)
+        self._table = table
+
+    def _run(self, every):
+        return super()._run(every, table=self._table)
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def compare(rider, workout, route, reference_dt=0.001):
+    """Accuracy of the fixed step simulators and the event integrator against a fine step reference
+
+    The reference reruns the stepper with a much smaller `dt`, which converges on the exact
+    solution of the model, so the deltas show the error each approach introduces (the
+    `estimate` mode's included).
+    """
+    workout, route = engine._profiles(workout, route, engine.DT)
+    reference, _ = _timed(lambda: engine.simulate(rider, engine.WorkoutProfile(workout.workout, reference_dt), route))
+    stepper, stepper_time = _timed(lambda: engine.simulate(rider, workout, route))
+    events, events_time = _timed(lambda: EventRide(rider, workout, route).summary())
+    table = physics.SpeedTable.cached(rider)
+    estimate, estimate_time = _timed(lambda: EstimatedRide(rider, workout, route).summary())
+
+    def deltas(summary, runtime):
+        splits = [a - b for (a, _), (b, _) in zip(summary.laps, reference.laps)]
+        return {
+            'distance_m': (summary.distance - reference.distance) * 1000,
+            'climbed_m': summary.climbed - reference.climbed,
+            'time_s': summary.time - reference.time,
+            'max_split_s': max((abs(s) for s in splits), default=0),
+            'laps': len(summary.laps) - len(reference.laps),
+            'runtime_s': runtime,
+        }
+
+    return {
+        'route': route.name,
+        'workout_time_s': workout.workout_time,
+        'reference_distance_km': reference.distance,
+        'stepper': deltas(stepper, stepper_time),
+        'events': deltas(events, events_time),
+        'estimate': deltas(estimate, estimate_time),
+        'table_max_error_ms': table.max_error,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import route
+    import stream_cache
+    import strava
+    import workouts
+
+    p = argparse.ArgumentParser(prog='ZwiftIntegratorAccuracy')
+    p.add_argument('route')
+    p.add_argument('-w', '--workout', default='ftp-builder.week-5-day-2-threshold-development')
+    p.add_argument('-m', '--weight', type=float, default=90)
+    p.add_argument('-e', '--height', type=int, default=180)
+    p.add_argument('-f', '--ftp', type=int, default=256)
+    p.add_argument('-b', '--bike', default='emonda')
+    p.add_argument('-c', '--wheels', default='meilensteins')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    args = p.parse_args()
+
+    me = physics.Rider(args.weight, args.height, args.ftp)
+    me.set_bike(physics.BIKES.get(args.bike))
+    me.set_wheels(physics.WHEELS.get(args.wheels))
+
+    client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                       connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                       offline=args.offline)
+    bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+    r = route.load_route(args.route, client, bundle)
+
+    w = workouts.WorkoutLoader(me).load_workout(name=args.workout)
+    result = compare(me, w, r)
+
+    print(f"{result['route']}: reference distance {result['reference_distance_km']:.3f}km over {result['workout_time_s']}s")
+    for name in ('stepper', 'events', 'estimate'):
+        r = result[name]
+        print(f"{name:>8}: distance {r['distance_m']:+.2f}m time {r['time_s']:+.2f}s worst split {r['max_split_s']:.2f}s in {r['runtime_s']:.3f}s")
+    print(f"estimate speed table accurate to {result['table_max_error_ms']:.3f}m/s")
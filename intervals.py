@@ -3,6 +3,8 @@ from datetime import timedelta
 import math
 import re
 
+import numpy as np
+
 
 _TIMEDELTA = re.compile((r'((?P<days>-?\d+)d)?'
                    r'((?P<hours>-?\d+)h)?'
@@ -78,8 +80,8 @@ class Interval(object):
 class FreeRideInterval(Interval):
     MATCHER = re.compile(r'((?P<timem>\d+)min *)?((?P<times>\d+)sec *)?(@(?P<cadence>\d+)rpm)? free ride')
 
-    def __init__(self, raw_str):
-        super().__init__(raw_str, FreeRideInterval.MATCHER)
+    def __init__(self, raw_str, **kwargs):
+        super().__init__(raw_str, FreeRideInterval.MATCHER, **kwargs)
 
     def __repr__(self):
         return f'Free Ride for {self.time}'
@@ -104,8 +106,8 @@ class SteadyInterval(Interval):
 class RampInterval(Interval):
     MATCHER = re.compile(r'((?P<timem>\d+)min *)?((?P<times>\d+)sec *)?(@ (?P<cadence>\d+)rpm,? )?from (?P<pct_ftp>\d+) to ((?P<end_pct>\d+)%) FTP')
 
-    def __init__(self, raw_str):
-        super().__init__(raw_str, RampInterval.MATCHER)
+    def __init__(self, raw_str, **kwargs):
+        super().__init__(raw_str, RampInterval.MATCHER, **kwargs)
 
     def __repr__(self):
         end = self._interval['end_pct']
@@ -143,3 +145,183 @@ def parse_interval(raw_str):
     if 'x' in raw_str:
         return SetInterval(raw_str)
     return SteadyInterval(raw_str)
+
+
+# Ramps are ridden as a staircase of this many seconds per step (see `RampInterval.intervals`)
+RAMP_STEP = 15
+
+# Every interval kind in one pattern (targets either as % FTP or in watts) for `Workout.parse`,
+# matching the same text as the individual `MATCHER`s above
+_TOKEN = re.compile(r'(?:(?P<timem>\d+)min *)?(?:(?P<times>\d+)sec *)?(?:'
+                    r'(?:@(?P<free_cadence>\d+)rpm)? (?P<free>free ride)'
+                    r'|(?:@ (?P<ramp_cadence>\d+)rpm,? )?from (?P<from>\d+) to (?P<to>\d+)(?P<ramp_unit>% FTP|W)'
+                    r'|@ (?:(?P<cadence>\d+)rpm, )?(?P<pct>\d+)(?P<unit>% FTP|W))')
+_REPS = re.compile(r'(?P<reps>\d+)x ')
+
+
+def _pct(value, unit, ftp):
+    # Watts are converted the same (truncating) way whatsonzwift pages were converted to text before
+    if unit == 'W':
+        if ftp is None:
+            raise Exception(f'Need an ftp to convert {value}W to % FTP')
+        value = int(int(value) / ftp * 100)
+    return int(value) / 100
+
+
+def _tokenize(text, ftp):
+    """Rows `(kind, duration, start_pct, end_pct, cadence)` of one interval (or set) along with its reps"""
+    s = _REPS.match(text)
+    pos, rows = (s.end() if s else 0), []
+    while True:
+        m = _TOKEN.match(text, pos)
+        if not m or not (m['timem'] or m['times']):
+            raise Exception(f"Failed to parse interval - didn't match regex={text[pos:]}")
+        duration = int(m['timem'] or 0) * 60 + int(m['times'] or 0)
+        if m['free']:
+            rows.append((Workout.FREE_RIDE, duration, 0, math.nan, int(m['free_cadence'] or 0)))
+        elif m['from']:
+            rows.append((Workout.RAMP, duration, _pct(m['from'], m['ramp_unit'], ftp),
+                         _pct(m['to'], m['ramp_unit'], ftp), int(m['ramp_cadence'] or 0)))
+        else:
+            rows.append((Workout.STEADY, duration, _pct(m['pct'], m['unit'], ftp), math.nan, int(m['cadence'] or 0)))
+        # Intervals of a set are separated by a single character
+        pos = m.end() + 1
+        if not s or pos >= len(text):
+            return rows, int(s['reps']) if s else 1
+
+
+class Workout(object):
+    """Timeline of a workout as parallel arrays instead of a list of `Interval` objects
+
+    Every row is one steady, ramp or free ride interval. Ramps stay a single row and the rows of
+    a set are only kept once along with how many times the set repeats, so nothing is expanded
+    until the individual steps are asked for. `power_at` looks up the target watts for any
+    array of times in one call.
+    """
+
+    STEADY, FREE_RIDE, RAMP = 0, 1, 2
+
+    def __init__(self, kind, duration, start_pct, end_pct, cadence, group=None, reps=None):
+        # Rows of group `g` are contiguous and ridden `reps[g]` times in a row (groups default to one row each)
+        self.kind = np.asarray(kind, dtype=np.uint8)
+        self.duration = np.asarray(duration, dtype=np.int64)
+        self.start_pct = np.asarray(start_pct, dtype=float)
+        self.end_pct = np.asarray(end_pct, dtype=float)
+        self.cadence = np.asarray(cadence, dtype=np.int64)
+        n = len(self.kind)
+        self.group = np.arange(n) if group is None else np.asarray(group, dtype=np.intp)
+        self.reps = np.ones(n, dtype=np.int64) if reps is None else np.asarray(reps, dtype=np.int64)
+
+        is_ramp = self.kind == self.RAMP
+        self.length = np.where(is_ramp, RAMP_STEP * (self.duration // RAMP_STEP + 1), self.duration)
+        self.slope = np.zeros(n)
+        self.slope[is_ramp] = (self.end_pct[is_ramp] - self.start_pct[is_ramp]) / self.duration[is_ramp]
+
+        # Offset of every row within one repetition of its group, and where each group starts
+        groups = len(self.reps)
+        self.first = np.searchsorted(self.group, np.arange(groups))
+        self.period = np.bincount(self.group, weights=self.length, minlength=groups).astype(np.int64)
+        ends = np.cumsum(self.length)
+        self.start = ends - self.length - np.concatenate(([0], ends))[self.first][self.group]
+        self.group_start = np.concatenate(([0], np.cumsum(self.period * self.reps)))
+        self.workout_time = int(self.group_start[-1])
+        self.group_start = self.group_start[:-1]
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """Workout of parsed intervals, either as parsed or already expanded through `intervals()`"""
+        rows, group, reps = [], [], []
+        for interval in intervals:
+            block = interval._rep if isinstance(interval, SetInterval) else [interval]
+            for i in block:
+                rows.extend(i.intervals() if isinstance(i, SetInterval) else [i])
+                group.extend([len(reps)] * (len(rows) - len(group)))
+            reps.append(interval._interval['reps'] if isinstance(interval, SetInterval) else 1)
+
+        kinds = {FreeRideInterval: cls.FREE_RIDE, RampInterval: cls.RAMP}
+        kind = [kinds.get(type(i), cls.STEADY) for i in rows]
+        return cls(kind, [i.duration for i in rows],
+                   [0 if k == cls.FREE_RIDE else i.pct_ftp for k, i in zip(kind, rows)],
+                   [i._interval.get('end_pct', math.nan) for i in rows],
+                   [i.cadence or 0 for i in rows], group, reps)
+
+    @classmethod
+    def parse(cls, texts, ftp=None):
+        """Workout straight from interval texts in a single pass, without building `Interval`s
+
+        Targets given in watts (as pages showing watts list them) are converted with `ftp`.
+        """
+        rows, group, reps = [], [], []
+        for text in texts:
+            block, r = _tokenize(text, ftp)
+            rows.extend(block)
+            group.extend([len(reps)] * len(block))
+            reps.append(r)
+        columns = list(zip(*rows)) or [()] * 5
+        return cls(*columns, group, reps)
+
+    def flattened(self):
+        """`(kind, duration, start_pct, end_pct, cadence)` with the sets written out but ramps still whole"""
+        rows = np.arange(len(self.kind))
+        idx = np.concatenate([np.tile(rows[self.group == g], r) for g, r in enumerate(self.reps.tolist())] or [rows])
+        return self.kind[idx], self.duration[idx], self.start_pct[idx], self.end_pct[idx], self.cadence[idx]
+
+    def _steps(self):
+        # Row, offset into the row and length of every step of the ridden timeline, ramps as their 15s steps
+        counts = np.where(self.kind == self.RAMP, self.length // RAMP_STEP, 1)
+        row = np.repeat(np.arange(len(self.kind)), counts)
+        offset = (np.arange(len(row)) - np.repeat(np.cumsum(counts) - counts, counts)) * RAMP_STEP
+        offset = np.where(self.kind[row] == self.RAMP, offset, 0)
+        idx = np.concatenate([np.tile(np.flatnonzero(self.group[row] == g), r) for g, r in enumerate(self.reps.tolist())]
+                             or [np.arange(0)])
+        return row[idx], offset[idx]
+
+    def _watts(self, row, offset, ftp):
+        pct = np.where(self.kind[row] == self.RAMP, self.slope[row] * offset + self.start_pct[row], self.start_pct[row])
+        return np.where(self.kind[row] == self.FREE_RIDE, 100, np.round(pct * ftp))
+
+    @property
+    def durations(self):
+        """Seconds of every step, as `Interval.intervals` would expand the workout"""
+        row, _ = self._steps()
+        return np.where(self.kind[row] == self.RAMP, RAMP_STEP, self.duration[row])
+
+    def watts(self, ftp):
+        """Target watts of every step"""
+        return self._watts(*self._steps(), ftp)
+
+    def power_at(self, t, ftp):
+        """Target watts at each of the times (s) in `t`, 0 outside of the workout"""
+        t = np.asarray(t, dtype=float)
+        if not len(self.kind):
+            return np.zeros(t.shape)
+        g = np.clip(np.searchsorted(self.group_start, t, side='right') - 1, 0, len(self.reps) - 1)
+        local = (t - self.group_start[g]) % np.maximum(self.period[g], 1)
+
+        # Rows sorted by (group, start) so a single search finds the row of every time
+        scale = float(self.period.max() + 1)
+        row = np.searchsorted(self.group * scale + self.start, g * scale + local, side='right') - 1
+        offset = np.floor((local - self.start[row]) / RAMP_STEP) * RAMP_STEP
+        watts = self._watts(row, offset, ftp)
+        return np.where((t >= 0) & (t < self.workout_time), watts, 0)
+
+    def _row_interval(self, r):
+        d, c = int(self.duration[r]), int(self.cadence[r]) or None
+        fields = {'duration': d, 'time': f'{d // 60}m{d % 60}s', 'cadence': c}
+        if self.kind[r] == self.FREE_RIDE:
+            return FreeRideInterval('', **fields)
+        if self.kind[r] == self.RAMP:
+            return RampInterval('', pct_ftp=float(self.start_pct[r]), end_pct=float(self.end_pct[r]), **fields)
+        return SteadyInterval('', pct_ftp=float(self.start_pct[r]), **fields)
+
+    def __len__(self):
+        steps = np.where(self.kind == self.RAMP, self.length // RAMP_STEP, 1)
+        return int(np.sum(steps * self.reps[self.group]))
+
+    def __iter__(self):
+        # Same intervals (ramps expanded, sets repeated) as the list this replaces, built on the fly
+        for g, reps in enumerate(self.reps.tolist()):
+            rows = [self._row_interval(r) for r in np.flatnonzero(self.group == g).tolist()]
+            for _ in range(reps):
+                for interval in rows:
+                    yield from interval.intervals()
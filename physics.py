@@ -1,6 +1,9 @@
 
 import json
 import math
+import os
+
+import numpy as np
 
 
 # Zwift Physics Constants
@@ -11,8 +14,47 @@ AIR_DENSITY = 1.225 # kg/m**3
 
 # Taken from zwiftinsider tables
 # Not sure how to handle this overall as it can vary within a route (maybe world averages?)
-with open('road_values.json') as road_fp:
-    CRR_MAP = json.load(road_fp)['crr']
+# Only read once a wheel's rolling resistance is first needed, rather than on import
+_CRR_MAP = None
+
+
+def crr_map():
+    global _CRR_MAP
+    if _CRR_MAP is None:
+        with open('road_values.json') as road_fp:
+            _CRR_MAP = json.load(road_fp)['crr']
+    return _CRR_MAP
+
+
+def __getattr__(name):
+    # `CRR_MAP` used to be a module constant
+    if name == 'CRR_MAP':
+        return crr_map()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def terminal_velocity(watts, resistance, drag):
+    """Speed (m/s) at which `watts` exactly sustains the ride
+
+    Solves `drag*v**3 + resistance*v - watts = 0` for its positive root, where `resistance`
+    is the rolling plus gravitational force (N) and `drag` the aerodynamic coefficient
+    (N per (m/s)**2). Rider who can't hold any speed (ie. coasting up a hill) gets 0.
+    """
+    p, q = resistance / drag, -watts / drag
+    disc = (q / 2) ** 2 + (p / 3) ** 3
+    if disc > 0:
+        r = math.sqrt(disc)
+        v = math.copysign(abs(-q / 2 + r) ** (1 / 3), -q / 2 + r) + math.copysign(abs(-q / 2 - r) ** (1 / 3), -q / 2 - r)
+    else:
+        m = 2 * math.sqrt(-p / 3)
+        v = m * math.cos(math.acos(max(-1, min(1, 3 * q / (p * m)))) / 3) if p else 0
+    if v <= 0:
+        return 0
+
+    # Polish the root as Cardano loses precision when the terms nearly cancel
+    for _ in range(2):
+        v -= (drag * v * v * v + resistance * v - watts) / (3 * drag * v * v + resistance)
+    return max(v, 0)
 
 
 # Values taken from https://johnedevans.wordpress.com/2018/05/31/the-physics-of-zwift-cycling/
@@ -45,7 +87,11 @@ class WheelSet(CyclingObject):
 
     def __init__(self, aero: int, weight: int, _type: str):
         super().__init__(2.2 - weight*.2, .1801 - .0186*aero)
-        self._crr_map = CRR_MAP[_type]
+        self._type = _type
+
+    @property
+    def _crr_map(self):
+        return crr_map()[self._type]
 
     def crr(self, surfaces: dict):
         crr = 0
@@ -72,29 +118,53 @@ class Rider(CyclingObject):
 
         self._ftp = ftp
         self._v = 0
+        self._invalidate()
+
+    # Everything below only depends on the rider/equipment, gradient and surface mix, which stay
+    # the same for a whole segment, so it's worked out once per change rather than every tick.
+    # Surface mixes are assumed not to be mutated once handed to the rider.
+    def _invalidate(self):
+        self._cda = self._cd * self.frontal_area if self._bike else None
+        self._crr_cache = {}
+        self._gradient, self._surfaces = None, None
+        self._resistance = 0
+
+    def _set_regime(self, gradient: float, surfaces: dict):
+        fr = self._rolling_friction(gradient, surfaces)
+        fg = self._gravity_friction(gradient)
+        self._gradient, self._surfaces, self._resistance = gradient, surfaces, fr + fg
 
     def _rolling_friction(self, gradient: float, surfaces: dict):
-        return GRAVITY * math.cos(math.atan(gradient)) * self.mass * self._wheels.crr(surfaces)
+        return GRAVITY * math.cos(math.atan(gradient)) * self.mass * self.crr(surfaces)
 
     def _gravity_friction(self, gradient):
         return GRAVITY * math.sin(math.atan(gradient)) * self.mass
 
     def _drag_friction(self):
-        return self.cd * self.frontal_area * (self._v * self._v) * AIR_DENSITY / 2
+        return self.cda * (self._v * self._v) * AIR_DENSITY / 2
 
     def sustaining_power(self, gradient: float, surfaces: dict):
-        fr = self._rolling_friction(gradient, surfaces)
-        fg = self._gravity_friction(gradient)
+        if gradient != self._gradient or surfaces is not self._surfaces:
+            self._set_regime(gradient, surfaces)
         fd = self._drag_friction()
-        return (fr + fg + fd) * self._v
+        return (self._resistance + fd) * self._v
 
     # https://physics.stackexchange.com/questions/226854/how-can-i-model-the-acceleration-velocity-of-a-bicycle-knowing-only-the-power-ou
     def apply_watts(self, watts: int, gradient: float, dt: float, surfaces: dict):
         v = self._v
-        power_needed = self.sustaining_power(gradient, surfaces)
-        v = v*v + 2 * (watts - power_needed) * dt / self.mass
+        if gradient != self._gradient or surfaces is not self._surfaces:
+            self._set_regime(gradient, surfaces)
+        power_needed = (self._resistance + self._cda * (v * v) * AIR_DENSITY / 2) * v
+        v = v*v + 2 * (watts - power_needed) * dt / self._mass
         self._v = math.sqrt(v)
 
+    def crr(self, surfaces: dict):
+        key = tuple(surfaces.items())
+        crr = self._crr_cache.get(key)
+        if crr is None:
+            crr = self._crr_cache[key] = self._wheels.crr(surfaces)
+        return crr
+
     def reset(self):
         self._v = 0
         return self
@@ -103,6 +173,7 @@ class Rider(CyclingObject):
         sign = -1 if remove else 1
         self._cd += (obj.cd * sign)
         self._mass += (obj.mass * sign)
+        self._invalidate()
 
     def set_bike(self, bike):
         if not isinstance(bike, Bike):
@@ -127,15 +198,166 @@ class Rider(CyclingObject):
     def frontal_area(self):
         return 0.0276*math.pow(self._height / 100, 0.725)*math.pow(self.mass, 0.425) + self._bike.frontal_area
 
+    @property
+    def cda(self):
+        return self._cda
+
     @property
     def velocity(self):
         return self._v
 
+    @velocity.setter
+    def velocity(self, v):
+        self._v = v
+
     @property
     def ftp(self):
         return self._ftp
 
 
+class RiderBatch(object):
+    """Many riders as a structure of arrays, stepped together with NumPy
+
+    Keeps what `Rider.apply_watts` works with (mass, CdA, FTP and speed) as one array per
+    field with an entry per rider, so a tick for the whole group is a handful of array
+    operations. Rolling resistance still comes from each rider's wheels, per surface mix.
+    """
+
+    def __init__(self, riders):
+        self.riders = list(riders)
+        self.mass = np.array([r.mass for r in self.riders], dtype=float)
+        self.cda = np.array([r.cda for r in self.riders], dtype=float)
+        self.ftp = np.array([r.ftp for r in self.riders], dtype=float)
+        self.velocity = np.array([r.velocity for r in self.riders], dtype=float)
+
+    def __len__(self):
+        return len(self.riders)
+
+    def crr(self, surfaces: dict):
+        return np.array([r.crr(surfaces) for r in self.riders], dtype=float)
+
+    def apply_watts(self, watts, resistance, dt: float):
+        """Step every rider `dt` on, each at its `watts` against its `resistance` (N)"""
+        # Same arithmetic as `Rider.apply_watts`, done in place as for a few dozen riders the
+        # cost is all in the number of NumPy calls. Halving/doubling is exact, so folding those
+        # into the constants doesn't change a bit of the result. Where `math.sqrt` would fail
+        # (the rider stalled) the speed becomes NaN instead.
+        v = self.velocity
+        vv = v * v
+        p = self.cda * vv
+        p *= AIR_DENSITY / 2
+        p += resistance
+        p *= v
+        np.subtract(watts, p, out=p)
+        p *= 2 * dt
+        p /= self.mass
+        p += vv
+        self.velocity = np.sqrt(p, out=p)
+
+    def reset(self):
+        self.velocity = np.zeros(len(self.riders))
+        return self
+
+
+class SpeedTable(object):
+    """Steady state speed, and how quickly it's approached, over a grid of watts x resistance
+
+    Resistance (rolling plus gravitational force, N) folds gradient, surface and weight into a
+    single axis, so one table covers everything a rider/equipment setup rides; only its mass
+    and drag pick the table. `lookup` interpolates bilinearly, `max_error` being the worst
+    steady state speed error (m/s) of that over the table (checked at the middle of every cell).
+    Tables are kept on disk in `directory` by `cached`, as building one takes a moment.
+    """
+
+    # Steady state speed grows with the cube root of watts (steeply so near 0), so that's what's spaced evenly
+    WATTS = np.linspace(0, 2000 ** (1 / 3), 201) ** 3
+    RESISTANCE = np.linspace(-400, 400, 401)
+    # Speeds are floored here, as a ride that's as good as stopped would never finish a segment
+    MIN_SPEED = 0.1
+
+    def __init__(self, mass, cda, speed=None, time_constant=None, max_error=None):
+        self.mass, self.cda = mass, cda
+        self._drag = cda * AIR_DENSITY / 2
+        if speed is None:
+            speed = self._speeds(self.WATTS, self.RESISTANCE)
+            mid_w, mid_r = ((np.cbrt(self.WATTS[1:]) + np.cbrt(self.WATTS[:-1])) / 2) ** 3, (self.RESISTANCE[1:] + self.RESISTANCE[:-1]) / 2
+            max_error = float(np.abs(self._interpolate(speed, mid_w[:, None], mid_r[None, :])
+                                     - self._speeds(mid_w, mid_r)).max())
+            time_constant = mass * speed / (self.RESISTANCE[None, :] + 3 * self._drag * speed * speed)
+        self.speed, self.time_constant, self.max_error = speed, time_constant, max_error
+
+    def _speeds(self, watts, resistance):
+        v = [[terminal_velocity(w, r, self._drag) for r in resistance.tolist()] for w in watts.tolist()]
+        return np.maximum(np.array(v), self.MIN_SPEED)
+
+    def _interpolate(self, table, watts, resistance):
+        r0 = self.RESISTANCE[0]
+        dw, dr = np.cbrt(self.WATTS[1]), self.RESISTANCE[1] - r0
+        x = np.clip(np.cbrt(np.asarray(watts, dtype=float)) / dw, 0, len(self.WATTS) - 1)
+        y = np.clip((np.asarray(resistance, dtype=float) - r0) / dr, 0, len(self.RESISTANCE) - 1)
+        i, j = np.minimum(x.astype(np.intp), len(self.WATTS) - 2), np.minimum(y.astype(np.intp), len(self.RESISTANCE) - 2)
+        fx, fy = x - i, y - j
+        return ((table[i, j] * (1 - fy) + table[i, j + 1] * fy) * (1 - fx)
+                + (table[i + 1, j] * (1 - fy) + table[i + 1, j + 1] * fy) * fx)
+
+    def along(self, resistance):
+        """Function of watts giving the steady state speed on each of `resistance`
+
+        Cheaper than `lookup` for many different watts along the same route, as only the
+        watts are located in the table each time.
+        """
+        r0, dr = self.RESISTANCE[0], self.RESISTANCE[1] - self.RESISTANCE[0]
+        y = np.clip((np.asarray(resistance, dtype=float) - r0) / dr, 0, len(self.RESISTANCE) - 1)
+        j = np.minimum(y.astype(np.intp), len(self.RESISTANCE) - 2)
+        fy = y - j
+        dw = np.cbrt(self.WATTS[1])
+
+        def speeds(watts):
+            x = min(max(float(np.cbrt(watts)) / dw, 0), len(self.WATTS) - 1)
+            i = min(int(x), len(self.WATTS) - 2)
+            row = self.speed[i] * (1 - (x - i)) + self.speed[i + 1] * (x - i)
+            return row[j] * (1 - fy) + row[j + 1] * fy
+        return speeds
+
+    def lookup(self, watts, resistance):
+        """Steady state speed (m/s) and time constant (s) of the approach to it, for each resistance
+
+        Inputs outside the table are clamped to its edges.
+        """
+        return self._interpolate(self.speed, watts, resistance), self._interpolate(self.time_constant, watts, resistance)
+
+    @staticmethod
+    def _path(directory, mass, cda):
+        grid = (SpeedTable.WATTS[-1], len(SpeedTable.WATTS),
+                SpeedTable.RESISTANCE[0], SpeedTable.RESISTANCE[-1], len(SpeedTable.RESISTANCE), SpeedTable.MIN_SPEED)
+        # Imported here as only cached speed tables need it
+        import hashlib
+        key = hashlib.sha1(
+repr((float(mass), float(cda), *grid)).encode()).hexdigest()[:16]
+        return os.path.join(directory, f'{key}.npz')
+
+    @classmethod
+    def cached(cls, rider, directory='speed_tables'):
+        """Table for the rider's current setup, built (and saved to `directory`) if not there yet"""
+        path = cls._path(directory, rider.mass, rider.cda)
+        table = _SPEED_TABLES.get(path)
+        if table is not None:
+            return table
+        if os.path.exists(path):
+            with np.load(path) as f:
+                table = cls(rider.mass, rider.cda, f['speed'], f['time_constant'], float(f['max_error']))
+        else:
+            table = cls(rider.mass, rider.cda)
+            os.makedirs(directory, exist_ok=True)
+            np.savez(path, speed=table.speed, time_constant=table.time_constant, max_error=table.max_error)
+        _SPEED_TABLES[path] = table
+        return table
+
+
+# Tables already loaded by `SpeedTable.cached`, by path
+_SPEED_TABLES = {}
+
+
 # Trawled from game data files
 # https://docs.google.com/spreadsheets/d/1O2NN5RHH3Q2j4uNjKJTkxqse-Ax2DOf7EcywS5O5-VE/edit#gid=0
 # emonda: cdA=0 weight=3.9kg
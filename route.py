@@ -1,11 +1,23 @@
 
 import copy
-from functools import reduce
-import gpxpy
-from gpxpy import geo as gpxgeo
+import itertools
 import json
+import logging
 import math
-import operator
+import numpy as np
+import threading
+
+import instrument
+
+
+log = logging.getLogger(__name__)
+
+
+# Same radius gpxpy uses, so distances line up with other gpx tooling
+EARTH_RADIUS = 6378.137 * 1000
+
+# Number of track points converted to distances at once while streaming a gpx file
+GPX_CHUNK = 4096
 
 
 class Point(object):
@@ -44,24 +56,146 @@ class Segment(object):
         return f'{self.length:.2f}m at {self.gradient * 100:.2f}%'
 
 
+def _douglas_peucker(x, y, tolerance):
+    """Mask of the profile points to keep so no dropped point is more than `tolerance` metres
+    above or below the straight line between its kept neighbours"""
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        span = x[b] - x[a]
+        slope = (y[b] - y[a]) / span if span > 0 else 0
+        err = np.abs(y[a + 1:b] - (y[a] + slope * (x[a + 1:b] - x[a])))
+        k = int(np.argmax(err))
+        if err[k] > tolerance:
+            keep[a + 1 + k] = True
+            stack.extend(((a, a + 1 + k), (a + 1 + k, b)))
+    return keep
+
+
+def simplify_segments(segments, tolerance):
+    """Merge runs of segments into longer constant gradient ones, within `tolerance` metres of elevation
+
+    Only contiguous segments are merged, so the joins between strava segments (which each restart
+    their distance at 0) are preserved.
+    """
+    runs, run = [], []
+    for s in segments:
+        if run and (s.start.distance != run[-1].end.distance or s.start.elevation != run[-1].end.elevation):
+            runs.append(run)
+            run = []
+        run.append(s)
+    if run:
+        runs.append(run)
+
+    simplified = []
+    for run in runs:
+        x = np.array([run[0].start.distance] + [s.end.distance for s in run])
+        y = np.array([run[0].start.elevation] + [s.end.elevation for s in run])
+        idx = np.flatnonzero(_douglas_peucker(x, y, tolerance))
+        simplified.extend(Segment(Point(x[a], y[a]), Point(x[b], y[b])) for a, b in zip(idx[:-1].tolist(), idx[1:].tolist()))
+    return simplified
+
+
+# Segment streams fetched at once by `SegmentFetcher`, see `stream_cache.RateLimiter` for staying within quota
+FETCH_WORKERS = 8
+
+
+class SegmentFetcher(object):
+    """Fetches segment streams from `client` concurrently on a bounded thread pool, each id only once
+
+    Stands in for the client wherever `route` takes one, so fetching every segment of a batch of
+    routes up front (`prefetch`) and then loading them one by one reaches strava once per distinct
+    segment, however many routes share it.
+    """
+
+    def __init__(self, client, workers=FETCH_WORKERS):
+        self._client = client
+        self._workers = workers
+        # Segment id -> (streams, None) or (None, the exception fetching it raised)
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _get(self, segment_id):
+        try:
+            return self._client.get_segment_streams(segment_id, types=['distance', 'altitude']), None
+        except Exception as e:
+            return None, e
+
+    @instrument.timed('segment_streams')
+    def _fetch_missing(self, segment_ids):
+        with self._lock:
+            missing = list(dict.fromkeys(sid for sid in segment_ids if sid not in self._results))
+        if len(missing) > 1 and self._workers > 1:
+            # Imported here as only loading routes from strava (or the stream cache) needs it
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(min(self._workers, len(missing))) as pool:
+                results = list(pool.map(self._get, missing))
+        else:
+            results = [self._get(sid) for sid in missing]
+        instrument.METRICS.count('segments_fetched', len(missing))
+        with self._lock:
+            self._results.update(zip(missing, results))
+            return [self._results[sid] for sid in segment_ids]
+
+    def fetch(self, segment_ids):
+        """Streams of every segment by id, fetching those not already held
+
+        Raises the first failure in id order, as fetching one at a time would.
+        """
+        results = self._fetch_missing(segment_ids)
+        for _, error in results:
+            if error is not None:
+                raise error
+        return {sid: streams for sid, (streams, _) in zip(segment_ids, results)}
+
+    def prefetch(self, names, bundle=None):
+        """Fetch the segments of every route in `names` (those not in `bundle`) ahead of loading them
+
+        Failures are kept rather than raised, and raised again when a route using the segment loads.
+        Returns the ids of the segments.
+        """
+        ids = []
+        for name in names:
+            if bundle is not None and name in bundle:
+                continue
+            world, _, route_ = name.partition('.')
+            details = route_directory().get(world, {}).get(route_)
+            if details and 'gpx' not in details:
+                ids.extend(details.get('lead_in', []) + details.get('lap', []))
+        ids = list(dict.fromkeys(ids))
+        self._fetch_missing(ids)
+        return ids
+
+    def get_segment_streams(self, segment_id, types=None):
+        return self.fetch([segment_id])[segment_id]
+
+
 class Lap(object):
     """Collection of strava segments that are ridden in order.
 
-    Provides easy access to total length and elevation gain.
+    Provides easy access to total length and elevation gain. With a `tolerance` the segments are
+    simplified (see `simplify_segments`) as the lap is built.
     """
 
-    def __init__(self, client, ids):
-        self._segments = self._load_lap(client, ids)
+    def __init__(self, client, ids, segments=None, tolerance=None):
+        self._segments = segments if segments is not None else self._load_lap(client, ids)
+        if tolerance:
+            self._segments = simplify_segments(self._segments, tolerance)
         self._len = sum(s.length for s in self._segments)
         self._elev = sum(s.elevation_gain for s in self._segments)
 
     def _load_lap(self, client, segments):
         if not segments:
             return []
-        return reduce(operator.concat, [self._grab_segment(client, sid) for sid in segments])
+        fetcher = client if isinstance(client, SegmentFetcher) else SegmentFetcher(client)
+        streams = fetcher.fetch(segments)
+        return list(itertools.chain.from_iterable(self._parse_streams(streams[sid]) for sid in segments))
 
-    def _grab_segment(self, client, segment_id):
-        s = client.get_segment_streams(segment_id, types=['distance', 'altitude'])
+    def _parse_streams(self, s):
         it = zip(s['distance'].data, s['altitude'].data)
         start = Point(*next(it))
         prev = None
@@ -80,6 +214,12 @@ class Lap(object):
 
         return segments
 
+    def simplified(self, tolerance):
+        return type(self)(None, None, segments=self._segments, tolerance=tolerance)
+
+    def __len__(self):
+        return len(self._segments)
+
     @property
     def length(self):
         return self._len / 1000
@@ -91,41 +231,94 @@ class Lap(object):
     def __iter__(self):
         return iter(self._segments)
 
+def _gpx_track_points(path, chunk=GPX_CHUNK):
+    """Streams `(lat, lon, elevation)` arrays of up to `chunk` points from every track segment of a gpx file
+
+    Elements are discarded as soon as they're read, so memory stays bounded regardless of file size.
+    Points without an elevation are skipped.
+    """
+    # Imported here as only gpx routes need an xml parser
+    import xml.etree.ElementTree as ET
+    lat, lon, ele = [], [], []
+    for _, elem in ET.iterparse(path):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'trkpt':
+            e = elem.find('{*}ele')
+            if e is not None and e.text:
+                lat.append(float(elem.get('lat')))
+                lon.append(float(elem.get('lon')))
+                ele.append(float(e.text))
+            elem.clear()
+            if len(lat) == chunk:
+                yield np.array(lat), np.array(lon), np.array(ele)
+                lat, lon, ele = [], [], []
+        elif tag in ('trkseg', 'trk'):
+            elem.clear()
+    if lat:
+        yield np.array(lat), np.array(lon), np.array(ele)
+
+
+def _gpx_points(path):
+    """Yields a `Point` per gpx track point with its cumulative 3d (haversine + climb) distance"""
+    last, covered = None, 0
+    for lat, lon, ele in _gpx_track_points(path):
+        if not len(lat):
+            continue
+        if last is not None:
+            lat, lon, ele = np.r_[last[0], lat], np.r_[last[1], lon], np.r_[last[2], ele]
+        else:
+            yield Point(0, ele[0])
+        if len(lat) < 2:
+            # A lone first point has nothing to measure from, it's carried into the next chunk
+            last = lat[-1], lon[-1], ele[-1]
+            continue
+
+        phi, lam = np.radians(lat), np.radians(lon)
+        h = np.sin(np.diff(phi) / 2) ** 2 + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(np.diff(lam) / 2) ** 2
+        flat = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1)))
+        dist = covered + np.cumsum(np.hypot(flat, np.diff(ele)))
+
+        for d, e in zip(dist.tolist(), ele[1:].tolist()):
+            yield Point(d, e)
+        covered, last = float(dist[-1]), (lat[-1], lon[-1], ele[-1])
+
+
 class GpxLap(Lap):
     """Customization to enable building a "lap" from a gpx file, in case strava segments are unavailable.
 
-    Mostly useful for integrating workout estimation with rouvy (though the physics are different)
+    Mostly useful for integrating workout estimation with rouvy (though the physics are different).
+    All track segments of all tracks are ridden in order as one lap.
     """
 
-    def __init__(self, client, ids):
-        super().__init__(client, ids)
+    def __init__(self, client, ids, segments=None, tolerance=None):
+        super().__init__(client, ids, segments, tolerance)
 
+    @instrument.timed('gpx_parse')
     def _load_lap(self, _client, segments):
-        with open(segments['gpx'], 'r') as f:
-            self._gpx = gpxpy.parse(f)
-
-        route = self._gpx.tracks[0].segments[0]
-        points = [
-            Point(gpxgeo.length_3d(route.points[:i]), point.elevation) for point, i in route.walk()
-        ]
-        start = points[0]
+        return list(self.iter_segments(segments['gpx']))
+
+    @staticmethod
+    def iter_segments(path):
+        """Yields the lap's segments while the gpx file is still being read"""
+        points = _gpx_points(path)
+        start = next(points, None)
+        if start is None:
+            return
         prev = None
-        segments = []
-        for p in points[1:]:
+        for p in points:
             if p.elevation == start.elevation:
                 prev = p
                 continue
             if prev is not None:
                 s = Segment(copy.copy(start), copy.copy(prev))
                 if s.length > 0:
-                    segments.append(s)
+                    yield s
                 start = prev
                 prev = None
             s = Segment(copy.copy(start), copy.copy(p))
             if s.length > 0:
-                segments.append(s)
+                yield s
             start = p
-        return segments
 
 # TODO(me): Add ability to customize laps as some routes just end.
 # Will likely need to be able to reverse/offset/trim/insert segments to fuly work
@@ -138,15 +331,19 @@ class Route(object):
     Surface information taken from https://zwiftmap.com/watopia
     """
 
-    def __init__(self, name, details, client):
+    def __init__(self, name, details, client, laps=None):
         self._name = name
+        self._details = details
         self._surfaces = details.get('surfaces', {})
-        self._leadin = Lap(client, details.get('lead_in', []))
         self._leadin_active = ('lead_in' in details)
 
-        if 'gpx' in details:
+        if laps is not None:
+            self._leadin, self._lap = laps
+        elif 'gpx' in details:
+            self._leadin = Lap(client, details.get('lead_in', []))
             self._lap = GpxLap(client, details)
         else:
+            self._leadin = Lap(client, details.get('lead_in', []))
             self._lap = Lap(client, details['lap'])
 
         self.attach_lap_reporter()
@@ -163,16 +360,46 @@ class Route(object):
     def active_lap(self):
         return self._leadin if self._leadin_active else self._lap
 
+    def simplified(self, tolerance):
+        """Copy of this route with both the lead-in and lap simplified to within `tolerance` metres"""
+        laps = self._leadin.simplified(tolerance), self._lap.simplified(tolerance)
+        return type(self)(self._name, self._details, None, laps=laps)
+
+    @property
+    def lead_in(self):
+        return self._leadin
+
+    @property
+    def lap(self):
+        return self._lap
+
+    @property
+    def lap_surfaces(self):
+        return self._surfaces
+
+    def lead_in_surfaces(self):
+        """Surface mix in effect for each segment of the lead in"""
+        return [self._surfaces for _ in self._leadin]
+
     def has_lead_in(self):
         return self._leadin.length > 0
 
     # Define iterator which traverses the leadin before repeatedly traversing the lap
     def __iter__(self):
-        while True:
-            for s in self.active_lap:
-                yield s
+        return self.iter_from(self._leadin_active)
+
+    def iter_from(self, lead_in, index=0):
+        """Iterate from segment `index` of the lead in (or of the lap), as `__iter__` would once there"""
+        self._leadin_active = lead_in
+        if lead_in:
+            yield from itertools.islice(self._leadin, index, None)
             self._leadin_active = False
             self._report_lap()
+            index = 0
+        while True:
+            yield from itertools.islice(self._lap, index, None)
+            index = 0
+            self._report_lap()
 
     def attach_lap_reporter(self, lap_reporter=None):
         if lap_reporter is None:
@@ -180,40 +407,190 @@ class Route(object):
         self._report_lap = lap_reporter
 
 class JungleLeadIn(Route):
-    def __init__(self, name, details, client):
-        super().__init__(name, details, client)
+    def __init__(self, name, details, client, laps=None):
+        super().__init__(name, details, client, laps)
         self._alpe_surface = self._surfaces.copy()
         self._alpe_surface.pop('dirt', None)
-        self._surfaces = { 'dirt': 1 }
+        self._surfaces = self._dirt_surface = { 'dirt': 1 }
+
+    @property
+    def lap_surfaces(self):
+        return self._alpe_surface
+
+    def lead_in_surfaces(self):
+        # Matches `__iter__`: segments starting within the first 5km are ridden on dirt
+        surfaces, covered = [], 0
+        for s in self._leadin:
+            surfaces.append({ 'dirt': 1 } if covered <= 5000 else self._alpe_surface)
+            covered += s.length
+        return surfaces
 
     # Define iterator which traverses the leadin before repeatedly traversing the lap
     def __iter__(self):
-        self._leadin_active = True
-        it = iter(self._leadin)
-        covered = 0
-        while covered <= 5000:
-            s = next(it)
-            covered += s.length
-            yield s
+        return self.iter_from(True)
+
+    def iter_from(self, lead_in, index=0):
+        self._leadin_active = lead_in
+        if lead_in:
+            covered = sum(s.length for s in itertools.islice(self._leadin, index))
+            self._surfaces = self._dirt_surface
+            for s in itertools.islice(self._leadin, index, None):
+                if covered > 5000:
+                    self._surfaces = self._alpe_surface
+                covered += s.length
+                yield s
+            self._report_lap()
+            self._leadin_active = False
+            index = 0
 
         self._surfaces = self._alpe_surface
-        for s in it:
-            yield s
-
-        self._report_lap()
-        self._leadin_active = False
-
         while True:
-            for s in self._lap:
-                yield s
+            yield from itertools.islice(self._lap, index, None)
+            index = 0
             self._report_lap()
 
 
-with open("routes.json") as fp:
-    ROUTE_DIRECTORY = json.load(fp)
+# Only read once a route is first looked up, rather than on import
+_ROUTE_DIRECTORY = None
+
+
+def _directory_hash(path='routes.json'):
+    # Stamped into bundles, so one compiled from another version of routes.json can be told apart
+    # Imported here as only opening and building bundles needs it
+    import hashlib
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def route_directory():
+    global _ROUTE_DIRECTORY
+    if _ROUTE_DIRECTORY is None:
+        with open("routes.json") as fp:
+            _ROUTE_DIRECTORY = json.load(fp)
+    return _ROUTE_DIRECTORY
+
+
+def __getattr__(name):
+    # `ROUTE_DIRECTORY` used to be a module constant
+    if name == 'ROUTE_DIRECTORY':
+        return route_directory()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _route_class(name):
+    return JungleLeadIn if name.split('.')[1] == 'road_to_sky' else Route
+
 
-def load_route(name, strava_client):
-    world, route_ = name.split('.')
-    if route_ == 'road_to_sky':
-        return JungleLeadIn(name, ROUTE_DIRECTORY[world][route_], strava_client)
-    return Route(name, ROUTE_DIRECTORY[world][route_], strava_client)
+@instrument.timed('load_route')
+def load_route(name, strava_client, bundle=None, tolerance=None):
+    if bundle is not None and name in bundle:
+        r = bundle.load(name)
+    else:
+        world, route_ = name.split('.')
+        r = _route_class(name)(name, route_directory()[world][route_], strava_client)
+    return r.simplified(tolerance) if tolerance else r
+
+
+def route_names():
+    return [f'{world}.{r}' for world, routes in route_directory().items() if world != 'comment' for r in routes]
+
+
+class RouteBundle(object):
+    """Compiled form of `ROUTE_DIRECTORY` written by `build_bundle`.
+
+    Every route's lead-in and lap are stored as `(start distance, start elevation, end distance,
+    end elevation)` rows, one per segment, in a single npz file. Arrays are only read from disk
+    when their route is loaded, so opening the bundle and loading one route is O(that route).
+
+    A bundle compiled from a different routes.json than the current one (or one too old to say)
+    holds no routes, so they're all loaded as if there was no bundle. Segment streams refreshed
+    since it was compiled aren't noticed, rebuild it after refreshing them.
+    """
+
+    def __init__(self, path='routes.npz'):
+        self._npz = np.load(path)
+        self._index = json.loads(str(self._npz['__index__']))
+        stamp = str(self._npz['__routes__']) if '__routes__' in self._npz.files else None
+        if stamp != _directory_hash():
+            log.warning('%s was compiled from another routes.json, loading routes without it '
+                        '(rebuild it with `python route.py`)', path)
+            self._index = {}
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self):
+        return list(self._index)
+
+    def totals(self, name):
+        """Lengths (km) and elevation gains (m) of the lead-in and lap, without loading the route"""
+        return self._index[name]['totals']
+
+    def _lap(self, name, part, lap_type=Lap):
+        rows = self._npz[f'{name}/{part}']
+        segments = [Segment(Point(a, b), Point(c, d)) for a, b, c, d in rows.tolist()]
+        return lap_type(None, None, segments=segments)
+
+    def load(self, name):
+        details = self._index[name]['details']
+        lap_type = GpxLap if 'gpx' in details else Lap
+        laps = self._lap(name, 'lead_in'), self._lap(name, 'lap', lap_type)
+        return _route_class(name)(name, details, None, laps=laps)
+
+
+def _segment_rows(lap):
+    rows = [(s.start.distance, s.start.elevation, s.end.distance, s.end.elevation) for s in lap]
+    return np.array(rows, dtype=float).reshape(-1, 4)
+
+
+def build_bundle(client, path='routes.npz', names=None):
+    """Resolve every route (or just `names`) into a bundle for `RouteBundle`
+
+    Routes which can't be loaded (eg. a gpx file that isn't on this machine) are reported and skipped.
+    """
+    arrays, index = {}, {}
+    names = names or route_names()
+    fetcher = SegmentFetcher(client)
+    fetcher.prefetch(names)
+    for name in names:
+        world, route_ = name.split('.')
+        details = route_directory()[world][route_]
+        try:
+            r = load_route(name, fetcher)
+        except Exception as e:
+            print(f'Skipping {name}: {e}')
+            continue
+
+        arrays[f'{name}/lead_in'] = _segment_rows(r.lead_in)
+        arrays[f'{name}/lap'] = _segment_rows(r.lap)
+        index[name] = {
+            'details': {k: v for k, v in details.items() if k != 'comment'},
+            'totals': {
+                'lead_in_length': r.lead_in.length,
+                'lead_in_elevation_gain': r.lead_in.elevation_gain,
+                'lap_length': r.lap.length,
+                'lap_elevation_gain': r.lap.elevation_gain,
+            },
+        }
+
+    np.savez(path, __index__=np.array(json.dumps(index)), __routes__=np.array(_directory_hash()), **arrays)
+
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    import stream_cache
+    import strava
+
+    p = argparse.ArgumentParser(prog='ZwiftRouteBundle')
+    p.add_argument('-o', '--output', default='routes.npz')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('routes', nargs='*', help='routes to compile, defaults to every route in routes.json')
+    args = p.parse_args()
+
+    client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                       connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                       offline=args.offline)
+    index = build_bundle(client, args.output, args.routes)
+    print(f'Compiled {len(index)} routes into {args.output}')
@@ -0,0 +1,244 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
+import batch
+import engine
+import instrument
+import integrator
+import route
+import stream_cache
+import strava
+import workouts
+
+
+log = logging.getLogger(__name__)
+
+
+# How long the first request for a route/workout waits for others to ride along with it
+COALESCE_WINDOW = 0.005
+MODES = ('engine', 'estimate')
+
+
+class _Pending(object):
+    # Riders waiting on one simulation, and what it came up with once `done` is set
+    def __init__(self):
+        self.setups = []
+        self.done = threading.Event()
+        self.summaries, self.error = None, None
+
+
+class Coalescer(object):
+    """Gathers concurrent requests with the same key into one call of `run`
+
+    The first request for a key waits `window` seconds, then calls `run` with every setup that
+    came in meanwhile (itself included) and hands each request its own result. Requests
+    arriving once `run` has started wait for the next call instead.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self._window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def submit(self, key, setup, run):
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _Pending()
+            index = len(pending.setups)
+            pending.setups.append(setup)
+
+        if leader:
+            time.sleep(self._window)
+            with self._lock:
+                del self._pending[key]
+            try:
+                pending.summaries = run(pending.setups)
+            except Exception as e:
+                pending.error = e
+            pending.done.set()
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.summaries[index], len(pending.setups)
+
+
+class EstimationService(object):
+    """Estimates kept warm between requests: routes, workouts and riders stay loaded once asked for
+
+    Does what `zwift.ZwiftController` does for a single ride, but for many concurrent callers.
+    Routes are loaded through `client` (or `bundle`) and workouts through a
+    `workouts.WorkoutLoader` the first time they're asked for. Estimates of the same route and
+    workout arriving together are simulated as one batch (see `Coalescer`), sharing lead-ins
+    through a resident `engine.Checkpoints`.
+    """
+
+    def __init__(self, client, bundle=None, loader=None, window=COALESCE_WINDOW):
+        self._client = client
+        self._bundle = bundle
+        self._loader = loader or workouts.WorkoutLoader(batch.RiderSetup().build())
+        self._routes, self._workouts, self._riders = {}, {}, {}
+        self._load_lock = threading.Lock()
+        # Simulations are CPU bound anyway, and this keeps the checkpoint cache consistent
+        self._simulate_lock = threading.Lock()
+        self._checkpoints = engine.Checkpoints()
+        self._coalescer = Coalescer(window)
+
+    def _cached(self, cache, name, load):
+        # Loaded once, under a lock so concurrent first requests don't all load it
+        if name not in cache:
+            with self._load_lock:
+                if name not in cache:
+                    cache[name] = load(name)
+        return cache[name]
+
+    def route(self, name):
+        return self._cached(self._routes, name,
+                            lambda n: engine.RouteProfile(route.load_route(n, self._client, self._bundle)))
+
+    def workout(self, name):
+        return self._cached(self._workouts, name, lambda n: engine.WorkoutProfile(self._loader.load_workout(name=n)))
+
+    def rider(self, setup):
+        return self._cached(self._riders, tuple(setup.as_dict().values()), lambda _: setup.build())
+
+    def preload(self, routes=(), workouts_=()):
+        """Load routes (fetching their segments concurrently) and workouts ahead of the first request"""
+        profiles, errors = batch.load_routes(routes, self._client, self._bundle)
+        with self._load_lock:
+            self._routes.update(profiles)
+        for name in workouts_:
+            self.workout(name)
+        return errors
+
+    def _simulate(self, route_name, workout_name, mode, setups):
+        profile, workout = self.route(route_name), self.workout(workout_name)
+        # The same rider asked for twice in one batch is only simulated once
+        keys = [tuple(s.as_dict().values()) for s in setups]
+        unique = {k: self.rider(s) for k, s in zip(keys, setups)}
+        riders = list(unique.values())
+        with self._simulate_lock, instrument.METRICS.timer('service_simulate'):
+            if mode == 'estimate':
+                summaries = [integrator.EstimatedRide(r, workout, profile).summary() for r in riders]
+            else:
+                summaries = engine.simulate_riders(riders, workout, profile, checkpoints=self._checkpoints)
+        by_key = dict(zip(unique, summaries))
+        instrument.METRICS.count('service_batches')
+        instrument.METRICS.count('service_rides', len(riders))
+        return [by_key[k] for k in keys]
+
+    def estimate(self, route_name, workout_name, setup=None, mode='engine'):
+        """`RideSummary.as_dict` of the ride, plus how many requests were simulated along with it"""
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode {mode}, expected one of {", ".join(MODES)}')
+        setup = setup or batch.RiderSetup()
+        # Built up front so a bad bike or wheel only fails this request, not the batch it joins
+        self.rider(setup)
+        instrument.METRICS.count('service_requests')
+        summary, batched = self._coalescer.submit(
+            (route_name, workout_name, mode), setup,
+            lambda setups: self._simulate(route_name, workout_name, mode, setups))
+        return {**summary.as_dict(), 'rider': setup.as_dict(), 'workout': workout_name, 'mode': mode, 'batched': batched}
+
+    def status(self):
+        return {
+            'routes': sorted(self._routes),
+            'workouts': sorted(self._workouts),
+            'riders': len(self._riders),
+            'metrics': instrument.METRICS.as_dict(),
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /status, POST /estimate with a json body:
+    #   {"route": "watopia.volcano_flat", "workout": "...", "rider": {"weight": 70, "ftp": 250}, "mode": "engine"}
+    service = None
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._reply(200, self.service.status())
+        else:
+            self._reply(404, {'error': f'No such endpoint {self.path}'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/estimate':
+            self._reply(404, {'error': f'No such endpoint {self.path}'})
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise TypeError(f'expected a json object, not {type(request).__name__}')
+            setup = batch.RiderSetup(**request.get('rider', {}))
+            names = request['route'], request['workout']
+        except (ValueError, TypeError, KeyError) as e:
+            self._reply(400, {'error': f'Bad request: {e!r}'})
+            return
+        try:
+            result = self.service.estimate(*names, setup, request.get('mode', 'engine'))
+        except (KeyError, ValueError) as e:
+            self._reply(400, {'error': f'Unknown route, workout, equipment or mode: {e}'})
+            return
+        except Exception as e:
+            log.exception('Estimate of %s failed', names)
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {**result, 'elapsed_ms': (time.perf_counter() - start) * 1000})
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    """HTTP server answering for `service` on a thread per connection (call `serve_forever` on it)"""
+    handler = type('Handler', (_Handler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(prog='ZwiftEstimateService')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('-p', '--port', type=int, default=8765)
+    p.add_argument('-r', '--route', action='append', default=[], help='route to load before serving (repeatable)')
+    p.add_argument('-w', '--workout', action='append', default=[], help='workout to load before serving (repeatable)')
+    p.add_argument('--window', type=float, default=COALESCE_WINDOW, help='seconds to gather requests for the same route and workout')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    p.add_argument('--log-level', default='INFO')
+    args = p.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s')
+
+    client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                       connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                       offline=args.offline)
+    bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+    service = EstimationService(client, bundle, window=args.window)
+    for name, error in service.preload(args.route, args.workout).items():
+        log.warning('Skipping %s: %s', name, error)
+
+    server = serve(service, args.host, args.port)
+    log.info('Serving estimates on http://%s:%s', *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
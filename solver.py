@@ -0,0 +1,245 @@
+import bisect
+import copy
+import heapq
+import itertools
+import math
+import os
+
+import numpy as np
+
+import engine
+import physics
+import route
+import stream_cache
+import strava
+import workouts
+
+
+class Candidate(object):
+    """One route ridden with one bike/wheel choice"""
+
+    def __init__(self, profile, rider, bike=None, wheels=None):
+        self.profile, self.rider = profile, rider
+        self.bike, self.wheels = bike, wheels
+        self.resist = profile.resistance(rider)
+        self.summary = None
+        self.pruned, self.error = False, None
+
+    def key(self, j):
+        # Everything riding segment `j` depends on, so candidates agreeing up to `j` ride it identically
+        p = self.profile
+        return p.length[j], p.gain[j], self.resist[j], j == p.lap_start
+
+    def remaining(self, distance):
+        """Metres from `distance` (m) to the next lap (or lead-in) boundary"""
+        lead_in, lap = self.profile.lead_in_length * 1000, self.profile.lap_length * 1000
+        if distance < lead_in:
+            return lead_in - distance
+        return lap - (distance - lead_in) % lap
+
+    def can_beat(self, state, workout, speeds, threshold):
+        # Speed stays within `speeds` (see `_speed_bounds`), so the ride will finish somewhere in
+        # [d + vmin*time left, d + vmax*time left] and can only beat `threshold` if a boundary lies
+        # just beyond some point of that. Time left goes by the workout's last tick, which can be a
+        # little past `workout_time`. Laps are only counted on the tick after crossing, hence
+        # looking back a tick's distance.
+        k = min(bisect.bisect_right(workout.ends.tolist(), state.tick), len(speeds[0]) - 1)
+        vmin, vmax = min(state.v, speeds[0][k]), max(state.v, speeds[1][k])
+        left = max(workout.time - state.t, 0)
+        slack = vmax * workout.dt
+        start = state.d + vmin * left - slack
+        return start + self.remaining(start) - threshold < state.d + vmax * left + slack
+
+    def row(self):
+        s = self.summary
+        return {
+            'route': self.profile.name,
+            'bike': self.bike,
+            'wheels': self.wheels,
+            'remaining_km': s.remaining_distance,
+            'lap_completion': s.partial_distance / s.active_lap_length,
+            'laps': s.completed_laps,
+            'distance_km': s.distance,
+        }
+
+
+def _speed_bounds(candidate, workout):
+    # From each interval on, speed only ever moves towards a terminal velocity somewhere between
+    # the slowest (least power up the steepest climb) and fastest (most power down the steepest
+    # descent) of what's left of the workout. A tick sets v*v to g(v) = v*v + 2*dt/m*(watts -
+    # resistance*v - drag*v**3), which is convex at any speed a bike reaches, so it can't step past
+    # the fastest (or sqrt(g(0)) if that's more), and increasing above a fraction of a m/s, so it
+    # can't step below the slowest unless that's slower still (when 0 is all that's certain).
+
+    rider = candidate.rider
+    drag, mass, dt = rider.cda * physics.AIR_DENSITY / 2, rider.mass, workout.dt
+    watts = workout.watts(rider.ftp)
+    if not len(watts):
+        return [0], [0]
+    least = np.minimum.accumulate(watts[::-1])[::-1].tolist()
+    most = np.maximum.accumulate(watts[::-1])[::-1].tolist()
+    steepest, easiest = float(candidate.resist.max()), float(candidate.resist.min())
+    disc = mass * mass - 12 * drag * dt * dt * steepest
+    turn = (mass - math.sqrt(disc)) / (6 * drag * dt) if disc >= 0 else float('inf')
+    slowest = [v if v >= turn else 0 for v in (physics.terminal_velocity(w, steepest, drag) for w in least)]
+    fastest = [max(physics.terminal_velocity(w, easiest, drag), math.sqrt(2 * dt * w / mass)) for w in most]
+    return slowest, fastest
+
+
+
+class _Ranking(object):
+    # Best `top` leftover distances found so far (in metres), the worst of which is the bar to beat
+    def __init__(self, top):
+        self.top, self.best = top, []
+
+    @property
+    def threshold(self):
+        return -self.best[0] if self.top and len(self.best) >= self.top else float('inf')
+
+    def add(self, remaining):
+        heapq.heappush(self.best, -remaining)
+        if self.top and len(self.best) > self.top:
+            heapq.heappop(self.best)
+
+
+def _finish(candidate, workout, state, ranking, prune):
+    it = engine._integrate(candidate.rider, workout, candidate.profile, None, state)
+    speeds = _speed_bounds(candidate, workout)
+    try:
+        while True:
+            next(it)
+            if prune and not candidate.can_beat(state, workout, speeds, ranking.threshold):
+                candidate.pruned = True
+                return
+    except StopIteration as done:
+        candidate.summary = done.value
+    except Exception as e:
+        candidate.error = str(e)
+        return
+    ranking.add(candidate.summary.remaining_distance * 1000)
+
+
+def _solve(group, workout, state, depth, ranking, prune):
+    """Ride the segments a group of candidates has in common once, then split up where they differ"""
+    if len(group) == 1:
+        _finish(group[0], workout, state, ranking, prune)
+        return
+
+    # Longest run of segments (from `depth`) that every candidate rides the same way
+    shortest = min(len(c.profile) for c in group)
+    end = depth
+    while end < shortest and len({c.key(end) for c in group}) == 1:
+        end += 1
+
+    if end > depth:
+        lead = group[0]
+        it = engine._integrate(lead.rider, workout, lead.profile, None, state, pause_at=end)
+        try:
+            for _ in it:
+                pass
+        except StopIteration as done:
+            if done.value is not None:
+                # The workout finished within the shared segments
+                _share(group, workout, state, ranking)
+                return
+
+    branches = {}
+    for c in group:
+        branches.setdefault(c.key(end) if end < len(c.profile) else None, []).append(c)
+    for key, branch in branches.items():
+        if key is None and len(branch) > 1:
+            # Identical all the way to the end of the lap, so every lap after is ridden the same too
+            final = state.copy()
+            _finish(branch[0], workout, final, ranking, prune)
+            for c in branch:
+                c.pruned, c.error = branch[0].pruned, branch[0].error
+            if branch[0].summary is not None:
+                _share(branch, workout, final, ranking)
+        else:
+            _solve(branch, workout, state.copy(), end, ranking, prune)
+
+
+def _share(group, workout, state, ranking):
+    # Candidates that rode identically to the end of the workout (`state`) finish in the same place
+    for c in group:
+        if c.summary is None:
+            c.summary = engine.RideSummary.of(c.profile, workout.workout_time, list(state.laps), state.d, state.climbed, state.t)
+            ranking.add(c.summary.remaining_distance * 1000)
+
+
+def rank_routes(rider, workout, profiles, equipment=None, top=None, prune=True, dt=engine.DT):
+    """Rank routes (and bike/wheel choices) by how far short of a lap boundary the workout finishes
+
+    `profiles` are `engine.RouteProfile`s and `equipment` a list of `(bike, wheels)` names from
+    `physics.BIKES`/`physics.WHEELS` (the rider as set up otherwise). Routes are simulated as a
+    tree: segments a group of candidates would ride identically (typically a shared lead-in)
+    are only simulated once. With `top` only the best `top` are wanted, and a candidate is
+    abandoned as soon as it can no longer finish closer to a boundary than the current `top`th.
+
+    Returns the ranked rows along with how many candidates were abandoned and why any route
+    couldn't be ridden.
+    """
+    workout = workout if isinstance(workout, engine.WorkoutProfile) else engine.WorkoutProfile(workout, dt)
+    candidates = []
+    for bike, wheels in equipment or [(None, None)]:
+        r = copy.deepcopy(rider)
+        if bike is not None:
+            r.set_bike(physics.BIKES[bike])
+        if wheels is not None:
+            r.set_wheels(physics.WHEELS[wheels])
+        candidates.extend(Candidate(p, r, bike, wheels) for p in profiles if len(p))
+
+    ranking = _Ranking(top if prune else None)
+    for _, group in itertools.groupby(candidates, key=lambda c: id(c.rider)):
+        group = list(group)
+        _solve(group, workout, engine.RideState(group[0].rider.velocity), 0, ranking, prune)
+
+    finished = sorted((c for c in candidates if c.summary is not None), key=lambda c: c.summary.remaining_distance)
+    rows = [c.row() for c in finished][:top]
+    errors = {c.profile.name: c.error for c in candidates if c.error}
+    return rows, {'abandoned': sum(c.pruned for c in candidates), 'errors': errors}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(prog='ZwiftRouteSolver')
+    p.add_argument('-w', '--workout', default='ftp-builder.week-5-day-2-threshold-development')
+    p.add_argument('-r', '--route', action='append', help='route to consider (default: every route in routes.json)')
+    p.add_argument('-m', '--weight', type=float, default=90)
+    p.add_argument('-e', '--height', type=int, default=180)
+    p.add_argument('-f', '--ftp', type=int, default=256)
+    p.add_argument('-b', '--bike', default='emonda')
+    p.add_argument('-c', '--wheels', default='meilensteins')
+    p.add_argument('--equipment', action='store_true', help='also try every bike and wheel combination')
+    p.add_argument('-n', '--top', type=int, default=10)
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    args = p.parse_args()
+
+    me = physics.Rider(args.weight, args.height, args.ftp)
+    me.set_bike(physics.BIKES.get(args.bike))
+    me.set_wheels(physics.WHEELS.get(args.wheels))
+
+    client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                       connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                       offline=args.offline)
+    bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+    names = args.route or route.route_names()
+    fetcher = route.SegmentFetcher(client)
+    fetcher.prefetch(names, bundle)
+    profiles = []
+    for name in names:
+        try:
+            profiles.append(engine.RouteProfile(route.load_route(name, fetcher, bundle)))
+        except Exception as e:
+            print(f'Skipping {name}: {e}')
+
+    equipment = list(itertools.product(physics.BIKES, physics.WHEELS)) if args.equipment else None
+    rows, stats = rank_routes(me, workouts.WorkoutLoader(me).load_workout(name=args.workout), profiles, equipment, args.top)
+    for r in rows:
+        kit = f" on {r['bike']}/{r['wheels']}" if r['bike'] else ''
+        print(f"{r['route']}{kit}: {r['remaining_km'] * 1000:.0f}m short of a lap ({r['lap_completion']:.1%} of the lap, {r['laps']} laps)")
+    for name, error in stats['errors'].items():
+        print(f'Skipped {name}: {error}')
+    print(f"{stats['abandoned']} candidates abandoned early")
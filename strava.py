@@ -1,8 +1,9 @@
 
 import json
-from stravalib.client import Client
 
 def init_client(client_id, client_secret, refresh_token):
+    # Imported here so that fully cached/offline runs never need stravalib
+    from stravalib.client import Client
     client = Client()
 
     refresh_response = client.refresh_access_token(
@@ -0,0 +1,191 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import instrument
+
+
+class Stream(object):
+    """Stand-in for the stravalib stream objects, only `data` is ever read from them"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+class StreamCache(object):
+    """Local store of strava segment streams, keyed by segment id.
+
+    Distance/altitude arrays are kept as packed float64 blobs in a single sqlite file, so loading
+    a route is a file read instead of a round-trip (and rate limit hit) per segment. Entries older
+    than `ttl` seconds are refetched when a client is available.
+    """
+
+    STREAMS = ('distance', 'altitude')
+
+    def __init__(self, path='segments.sqlite', ttl=None):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS streams ('
+                         'segment_id INTEGER PRIMARY KEY, fetched REAL, distance BLOB, altitude BLOB)')
+
+    def _is_stale(self, fetched):
+        return self._ttl is not None and time.time() - fetched > self._ttl
+
+    def get(self, segment_id, allow_stale=False):
+        """Cached `(distance, altitude)` arrays for the segment or None if missing (or stale)"""
+        with self._lock:
+            row = self._db.execute('SELECT fetched, distance, altitude FROM streams WHERE segment_id = ?',
+                                   (segment_id,)).fetchone()
+        if row is None or (self._is_stale(row[0]) and not allow_stale):
+            return None
+        return np.frombuffer(row[1], dtype='<f8'), np.frombuffer(row[2], dtype='<f8')
+
+    def put(self, segment_id, distance, altitude):
+        distance = np.asarray(distance, dtype='<f8')
+        altitude = np.asarray(altitude, dtype='<f8')
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?)',
+                             (segment_id, time.time(), distance.tobytes(), altitude.tobytes()))
+
+    def invalidate(self, segment_id=None):
+        """Drop one segment from the cache, or every segment if no id is given"""
+        with self._lock, self._db:
+            if segment_id is None:
+                self._db.execute('DELETE FROM streams')
+            else:
+                self._db.execute('DELETE FROM streams WHERE segment_id = ?', (segment_id,))
+
+    def segment_ids(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT segment_id FROM streams')]
+
+    def close(self):
+        self._db.close()
+
+
+# Strava's default application quotas as (requests, window in seconds): per 15 minutes and per day
+STRAVA_LIMITS = ((100, 15 * 60), (1000, 24 * 60 * 60))
+
+
+class RateLimiter(object):
+    """Token buckets, one per quota window, shared by every thread fetching from strava
+
+    Each bucket holds up to `limit` tokens and refills continuously at `limit` per window, and
+    `acquire` waits until every bucket can spare a token. Strava counts its windows from the
+    quarter hour and from midnight instead, so `backoff` holds every request back when a 429
+    says the quota ran out regardless (eg. used up by another process).
+    """
+
+    def __init__(self, limits=STRAVA_LIMITS, clock=time.monotonic, sleep=time.sleep):
+        self._limits = limits
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = [float(limit) for limit, _ in limits]
+        self._updated = clock()
+        self._blocked_until = self._updated
+
+    def _refill(self, now):
+        elapsed, self._updated = now - self._updated, now
+        self._tokens = [min(limit, tokens + elapsed * limit / window)
+                        for tokens, (limit, window) in zip(self._tokens, self._limits)]
+
+    def _wait(self, now):
+        # Seconds until a request may go out, taking the tokens if it can go now
+        self._refill(now)
+        wait = max([self._blocked_until - now] + [(1 - tokens) * window / limit
+                                                  for tokens, (limit, window) in zip(self._tokens, self._limits)])
+        if wait <= 0:
+            self._tokens = [tokens - 1 for tokens in self._tokens]
+        return wait
+
+    def acquire(self):
+        """Block until a request is allowed, then count it against every window"""
+        while True:
+            with self._lock:
+                wait = self._wait(self._clock())
+            if wait <= 0:
+                return
+            instrument.METRICS.add_time('rate_limit_wait', wait)
+            self._sleep(wait)
+
+    def backoff(self, seconds):
+        """Let no request through for `seconds`"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+
+
+# Shared by every `CachedClient` in the process, as they all draw on the same application quota
+LIMITER = RateLimiter()
+
+
+def rate_limit_wait(e):
+    """Seconds to wait if `e` is strava refusing a request for exceeding the rate limit, otherwise None"""
+    response = getattr(e, 'response', None)
+    status = getattr(e, 'status_code', None) or getattr(response, 'status_code', None)
+    # stravalib raises its own RateLimitExceeded (with a `timeout`) rather than the http error
+    if status != 429 and type(e).__name__ not in ('RateLimitExceeded', 'RateLimitTimeout'):
+        return None
+    if getattr(e, 'timeout', None):
+        return float(e.timeout)
+    retry_after = str(getattr(response, 'headers', {}).get('Retry-After', ''))
+    if retry_after.isdigit():
+        return float(retry_after)
+    # Otherwise wait for the next 15 minute window
+    return 15 * 60 - time.time() % (15 * 60)
+
+
+class CachedClient(object):
+    """Drop-in for the strava client as far as `route.Lap` is concerned.
+
+    Serves segment streams from a `StreamCache`, only reaching out to strava for missing or
+    expired segments. The strava client is created through `connect` on the first miss, so a
+    fully cached route never authenticates. With `offline` set strava is never contacted
+    (stale entries are served as-is) and missing segments raise instead.
+
+    Safe to share between threads (see `route.SegmentFetcher`). Requests to strava go through
+    `limiter` and are retried up to `retries` times when rate limited.
+    """
+
+    def __init__(self, cache, connect=None, offline=False, limiter=None, retries=3):
+        self._cache = cache
+        self._connect = connect
+        self._client = None
+        self._offline = offline or connect is None
+        self._limiter = limiter if limiter is not None else LIMITER
+        self._retries = retries
+        self._connect_lock = threading.Lock()
+
+    def _strava(self):
+        with self._connect_lock:
+            if self._client is None:
+                self._client = self._connect()
+        return self._client
+
+    def _fetch(self, segment_id):
+        for attempt in range(self._retries + 1):
+            self._limiter.acquire()
+            try:
+                with instrument.METRICS.timer('strava_fetch'):
+                    return self._strava().get_segment_streams(segment_id, types=list(StreamCache.STREAMS))
+            except Exception as e:
+                wait = rate_limit_wait(e)
+                if wait is None or attempt == self._retries:
+                    raise
+                instrument.METRICS.count('strava_rate_limited')
+                self._limiter.backoff(wait)
+
+    def get_segment_streams(self, segment_id, types=None):
+        streams = self._cache.get(segment_id, allow_stale=self._offline)
+        instrument.METRICS.count('stream_cache_hits' if streams is not None else 'stream_cache_misses')
+        if streams is None:
+            if self._offline:
+                raise Exception(f'Segment {segment_id} is not in the stream cache and strava is offline')
+            s = self._fetch(segment_id)
+            streams = s['distance'].data, s['altitude'].data
+            self._cache.put(segment_id, *streams)
+
+        return {name: Stream(np.asarray(data, dtype=float).tolist()) for name, data in zip(StreamCache.STREAMS, streams)}
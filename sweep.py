@@ -0,0 +1,199 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
+import numpy as np
+
+import batch
+import engine
+import physics
+import route
+import stream_cache
+import strava
+import workouts
+
+
+# Rider parameters that can be swept, and those of them distance can be searched along (how finely,
+# and within what range unless told otherwise)
+PARAMS = ('ftp', 'weight', 'height', 'bike', 'wheels')
+TOLERANCES = {'ftp': 1, 'weight': 0.1, 'height': 1}
+RANGES = {'ftp': (100, 500), 'weight': (50, 120), 'height': (150, 200)}
+
+
+# Workout and route of the sweep, set once per worker process by `_init_worker`
+_WORKOUT, _ROUTE = None, None
+
+
+def _init_worker(workout, route_):
+    global _WORKOUT, _ROUTE
+    _WORKOUT, _ROUTE = workout, route_
+
+
+def _ride(setups, workout=None, route_=None):
+    # Every sweep point is the same workout on the same route, so they're all ridden together
+    riders = [s.build() for s in setups]
+    workout = _WORKOUT if workout is None else workout
+    return engine.simulate_riders(riders, workout, _ROUTE if route_ is None else route_)
+
+
+class Sweep(object):
+    """A rider's estimates on one route and workout as one of its parameters (see `PARAMS`) varies
+
+    The route and workout profiles are built once and shared by every evaluation. Points are
+    independent rides, split over `processes` worker processes when given (the pool is kept
+    until `close`), and ridden together (see `engine.simulate_riders`) within each.
+    """
+
+    def __init__(self, setup, workout, route_, processes=None, dt=engine.DT):
+        self.setup = setup
+        self.workout, self.route = engine._profiles(workout, route_, dt)
+        self.evaluations = 0
+        self._processes = processes
+        self._pool = None
+
+    def evaluate(self, param, values):
+        """`engine.RideSummary` of the ride with each value of `param`"""
+        if param not in PARAMS:
+            raise Exception(f'Unknown parameter {param}, expected one of {", ".join(PARAMS)}')
+        setups = [batch.RiderSetup(**{**self.setup.as_dict(), param: v}) for v in values]
+        self.evaluations += len(setups)
+        if not self._processes or self._processes < 2 or len(setups) < 2:
+            return _ride(setups, self.workout, self.route)
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self._processes, initializer=_init_worker, initargs=(self.workout, self.route))
+        n = min(self._processes, len(setups))
+        summaries = [None] * len(setups)
+        for i, part in enumerate(self._pool.map(_ride, [setups[i::n] for i in range(n)])):
+            summaries[i::n] = part
+        return summaries
+
+    def curve(self, param, values):
+        """Distance, laps and lap completion for each value of `param`, as rows for `batch.write_rows`"""
+        return [{
+            param: v,
+            'laps': s.completed_laps,
+            'lap_completion': s.partial_distance / s.active_lap_length,
+            'remaining_km': s.remaining_distance,
+            'distance_km': s.distance,
+            'climbed_m': s.climbed,
+        } for v, s in zip(values, self.evaluate(param, values))]
+
+    def lap_distance(self, laps):
+        """Distance (km) ridden by the end of `laps` laps, after the lead-in"""
+        return self.route.lead_in_length + laps * self.route.lap_length
+
+    def find(self, param, lo, hi, distance, points=None, tolerance=None):
+        """Value of `param` in `[lo, hi]` closest to where the ride starts reaching `distance` (km)
+
+        Distance is taken to only ever grow (as with ftp) or only ever shrink (as with weight,
+        mostly) along `param`, so each round rides `points` values spread between the closest
+        short and long enough values so far, together, and narrows the range to the two either
+        side of the target, until they're within `tolerance`. That's plain bisection by default,
+        or a value per worker process. Returns the value that gets there along with its summary.
+        """
+        if param not in TOLERANCES:
+            raise Exception(f'Can only search along {", ".join(TOLERANCES)}, not {param}')
+        integer = param != 'weight'
+        tolerance = tolerance or TOLERANCES[param]
+        points = points or self._processes or 1
+        if integer:
+            # Whole numbers can't be told apart any closer than 1
+            tolerance = max(tolerance, 1)
+            lo, hi = round(lo), round(hi)
+
+        ends = self.evaluate(param, [lo, hi])
+        reach = [s.distance >= distance for s in ends]
+        if reach[0] == reach[1]:
+            raise Exception(f'{param} from {lo} to {hi} rides {ends[0].distance:.2f}km to {ends[1].distance:.2f}km, '
+                            f'not either side of {distance:.2f}km')
+        # `short` falls short of the distance and `far` gets there
+        (short, far), best = ((lo, hi), ends[1]) if reach[1] else ((hi, lo), ends[0])
+        while abs(far - short) > tolerance:
+            values = np.linspace(short, far, points + 2)[1:-1].tolist()
+            if integer:
+                values = [v for v in dict.fromkeys(round(v) for v in values) if v not in (short, far)]
+                if not values:
+                    break
+            for v, summary in zip(values, self.evaluate(param, values)):
+                if summary.distance >= distance:
+                    far, best = v, summary
+                    break
+                short = v
+        return far, best
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _values(param, text):
+    # `start:stop:step` (stop included) or a comma separated list, and every bike or wheel by default
+    if not text:
+        if param in ('bike', 'wheels'):
+            return list(physics.BIKES if param == 'bike' else physics.WHEELS)
+        raise Exception(f'--values is needed to sweep {param}')
+    if param in ('bike', 'wheels'):
+        return text.split(',')
+    if ':' in text:
+        start, stop, step = map(float, text.split(':'))
+        values = np.arange(start, stop + step / 2, step).round(6).tolist()
+    else:
+        values = [float(v) for v in text.split(',')]
+    # Only weight isn't a whole number
+    return values if param == 'weight' else [round(v) for v in values]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(prog='ZwiftSweep')
+    p.add_argument('route')
+    p.add_argument('-w', '--workout', default='ftp-builder.week-5-day-2-threshold-development')
+    p.add_argument('-m', '--weight', type=float, default=90)
+    p.add_argument('-e', '--height', type=int, default=180)
+    p.add_argument('-f', '--ftp', type=int, default=256)
+    p.add_argument('-b', '--bike', default='emonda')
+    p.add_argument('-c', '--wheels', default='meilensteins')
+    p.add_argument('-p', '--param', choices=PARAMS, default='ftp', help='rider parameter to sweep')
+    p.add_argument('--values', help='start:stop:step or a comma separated list (default: every bike or wheel)')
+    p.add_argument('--laps', type=float, help='search for where this many laps (after the lead-in) are completed')
+    p.add_argument('--distance', type=float, help='search for where this many km are ridden')
+    p.add_argument('--range', help='lo:hi to search within (default: the parameter\'s `RANGES`, eg. 50:120 for weight)')
+    p.add_argument('-j', '--processes', type=int)
+    p.add_argument('-o', '--output', help='.csv or .json file to write the curve to (default: csv to stdout)')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    args = p.parse_args()
+
+    setup = batch.RiderSetup(args.weight, args.height, args.ftp, args.bike, args.wheels)
+    client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                       connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                       offline=args.offline)
+    bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+    r = route.load_route(args.route, client, bundle)
+    workout = workouts.WorkoutLoader(setup.build()).load_workout(name=args.workout)
+
+    with Sweep(setup, workout, r, args.processes) as sweep:
+        if args.laps is not None or args.distance is not None:
+            distance = sweep.lap_distance(args.laps) if args.laps is not None else args.distance
+            lo, hi = map(float, args.range.split(':')) if args.range else RANGES.get(args.param, (None, None))
+
+            value, summary = sweep.find(args.param, lo, hi, distance)
+            print(f'{args.param}={value:g} rides {summary.distance:.2f}km ({summary.completed_laps} laps, '
+                  f'{summary.partial_distance / summary.active_lap_length:.1%} of the next), reaching {distance:.2f}km '
+                  f'after {sweep.evaluations} rides')
+        else:
+            rows = sweep.curve(args.param, _values(args.param, args.values))
+            if args.output:
+                with open(args.output, 'w', newline='') as f:
+                    batch.write_rows(rows, f, 'json' if args.output.endswith('.json') else 'csv')
+            else:
+                batch.write_rows(rows, sys.stdout)
@@ -0,0 +1,142 @@
+import zipfile
+
+import numpy as np
+
+import engine
+import instrument
+
+
+# Every column of a trace and its dtype on disk, in file order. Distance is in km, climbed in m.
+COLUMNS = (
+    ('time', '<f8'),
+    ('velocity', '<f4'),
+    ('distance', '<f8'),
+    ('climbed', '<f4'),
+    ('power', '<f4'),
+    ('gradient', '<f4'),
+    ('segment', '<i4'),
+    ('interval', '<i4'),
+)
+
+# Rows buffered before a chunk is written out, ie. what a trace costs in memory (~2MB)
+CHUNK_ROWS = 65536
+
+
+def _parquet_writer(path):
+    # Imported here as pyarrow is only needed for parquet traces
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('Writing parquet traces needs pyarrow, write to an .npz path instead')
+    schema = pa.schema([(name, pa.from_numpy_dtype(np.dtype(dtype))) for name, dtype in COLUMNS])
+    return pa, pq.ParquetWriter(path, schema)
+
+
+class TraceWriter(object):
+    """Streams ride ticks to a columnar file a chunk of `chunk_rows` rows at a time
+
+    Rows are copied into one preallocated buffer per column and written out whenever the
+    buffers fill, so memory stays at one chunk however long the ride. A `.parquet` path gets a
+    row group per chunk (needs pyarrow), anything else a zip of one `.npy` per column per
+    chunk (`time/000000.npy`, ...) which `read_trace` (or `np.load`) reads back.
+    """
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS, compress=False):
+        self.path = path
+        self.rows = 0
+        self._chunk_rows = chunk_rows
+        self._buffers = {name: np.empty(chunk_rows, dtype) for name, dtype in COLUMNS}
+        self._filled, self._chunks = 0, 0
+        self._zip = self._parquet = None
+        if path.endswith('.parquet'):
+            self._pa, self._parquet = _parquet_writer(path)
+        else:
+            self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+
+    def write(self, **columns):
+        """Append rows given as an array per column, where scalars stand for the same value on every row"""
+        n = len(columns['time'])
+        columns = {name: np.broadcast_to(columns[name], n) for name, _ in COLUMNS}
+        done = 0
+        while done < n:
+            take = min(n - done, self._chunk_rows - self._filled)
+            for name, buffer in self._buffers.items():
+                buffer[self._filled:self._filled + take] = columns[name][done:done + take]
+            self._filled += take
+            done += take
+            if self._filled == self._chunk_rows:
+                self._flush()
+        self.rows += n
+
+    def _flush(self):
+        if not self._filled:
+            return
+        if self._parquet is not None:
+            self._parquet.write_table(self._pa.table({name: b[:self._filled] for name, b in self._buffers.items()}))
+        else:
+            for name, buffer in self._buffers.items():
+                with self._zip.open(f'{name}/{self._chunks:06d}.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, buffer[:self._filled], allow_pickle=False)
+        self._chunks += 1
+        self._filled = 0
+
+    def close(self):
+        self._flush()
+        (self._parquet or self._zip).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_trace(path, columns=None):
+    """Whole columns (all by default) of an .npz trace written by `TraceWriter`, by name"""
+    dtypes = dict(COLUMNS)
+    with np.load(path) as npz:
+        chunks = sorted(npz.files)
+        return {name: np.concatenate([npz[k] for k in chunks if k.split('/')[0] == name] or [np.empty(0, dtypes[name])])
+                for name in columns or dtypes}
+
+
+@instrument.timed('export_trace')
+def export_trace(rider, workout, route, path, every=0, dt=engine.DT, chunk_rows=CHUNK_ROWS, compress=False):
+    """Ride the workout with `engine` and write a row every `every` seconds (every tick for 0) to `path`
+
+    Returns the ride's `engine.RideSummary`.
+    """
+    workout, route = engine._profiles(workout, route, dt)
+    watts = workout.watts(rider.ftp).tolist()
+    # The kernel yields one chunk per interval, in order
+    it = engine._integrate(rider, workout, route, every, segment_index=True)
+    with TraceWriter(path, chunk_rows, compress) as writer:
+        interval = 0
+        try:
+            while True:
+                chunk = next(it)
+                if chunk:
+                    v, d, climbed, t, segment = np.array(chunk).T
+                    segment = segment.astype(np.intp)
+                    writer.write(time=t, velocity=v, distance=d, climbed=climbed, power=watts[interval],
+                                 gradient=route.gradient[segment], segment=segment, interval=interval)
+                interval += 1
+        except StopIteration as done:
+            return done.value
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(prog='ZwiftTrace')
+    p.add_argument('trace', help='.npz trace written by `TraceWriter` (eg. `python zwift.py --trace-output`)')
+    p.add_argument('-n', '--rows', type=int, default=10, help='rows to print from the start')
+    args = p.parse_args()
+
+    columns = read_trace(args.trace)
+    print(f"{len(columns['time'])} rows")
+    names = [name for name, _ in COLUMNS]
+    print('\t'.join(names))
+    for row in zip(*(columns[name][:args.rows].tolist() for name in names)):
+        print('\t'.join(f'{x:.6g}' for x in row))
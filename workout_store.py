@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import intervals
+
+
+def _encode(workout):
+    # Sets are written out but ramps stay whole, with 0 cadence and NaN end_pct meaning "not set"
+    if not isinstance(workout, intervals.Workout):
+        workout = intervals.Workout.from_intervals(workout)
+    dtypes = ('<u1', '<i4', '<f8', '<f8', '<i4')
+    return tuple(np.asarray(c, dtype=t).tobytes() for c, t in zip(workout.flattened(), dtypes))
+
+
+def _decode(kind, duration, pct_ftp, end_pct, cadence):
+    return intervals.Workout(np.frombuffer(kind, dtype='<u1'), np.frombuffer(duration, dtype='<i4'),
+                             np.frombuffer(pct_ftp, dtype='<f8'), np.frombuffer(end_pct, dtype='<f8'),
+                             np.frombuffer(cadence, dtype='<i4'))
+
+
+class WorkoutStore(object):
+    """Local store of scraped workouts, keyed by plan and workout name.
+
+    Each workout is a row of packed columns (kind, duration, pct_ftp, end_pct, cadence) with one
+    entry per interval, so looking up a workout only decodes that workout and adding one is a
+    single upsert. Pages the workouts were downloaded from are remembered with their ETag and
+    Last-Modified headers so they're only downloaded again when changed. An existing jsonpickle
+    `workouts.json` cache is imported the first time an empty store is opened.
+    """
+
+    COLUMNS = ('kind', 'duration', 'pct_ftp', 'end_pct', 'cadence')
+
+    def __init__(self, path='workouts.sqlite', legacy_path='workouts.json'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS workouts (plan TEXT, workout TEXT, '
+                         'kind BLOB, duration BLOB, pct_ftp BLOB, end_pct BLOB, cadence BLOB, '
+                         'PRIMARY KEY (plan, workout))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)')
+        if legacy_path and os.path.exists(legacy_path) and not self.names():
+            self.import_json(legacy_path)
+
+    def import_json(self, path):
+        """Copy every workout of a jsonpickle cache (as written by older versions) into the store"""
+        import jsonpickle
+        with open(path) as f:
+            cache = jsonpickle.decode(f.read())
+        for plan, workouts in cache.items():
+            self.put_plan(plan, workouts)
+
+    def get(self, plan, workout):
+        """The stored `intervals.Workout` or None if it isn't stored"""
+        with self._lock:
+            row = self._db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM workouts WHERE plan = ? AND workout = ?',
+                                   (plan, workout)).fetchone()
+        return _decode(*row) if row is not None else None
+
+    def get_plan(self, plan):
+        """Every stored workout of the plan by name (empty if the plan isn't stored)"""
+        with self._lock:
+            rows = self._db.execute(f'SELECT workout, {", ".join(self.COLUMNS)} FROM workouts WHERE plan = ?',
+                                    (plan,)).fetchall()
+        return {row[0]: _decode(*row[1:]) for row in rows}
+
+    def put(self, plan, name, workout):
+        self.put_plan(plan, {name: workout})
+
+    def put_plan(self, plan, workouts):
+        rows = [(plan, name, *_encode(workout)) for name, workout in workouts.items()]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO workouts VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def validators(self, url):
+        """`(etag, last_modified)` the page at `url` was last stored with, (None, None) if never"""
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified FROM pages WHERE url = ?', (url,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def put_validators(self, url, etag, last_modified):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (url, etag, last_modified))
+
+    def names(self):
+        """`(plan, workout)` of every stored workout"""
+        with self._lock:
+            return self._db.execute('SELECT plan, workout FROM workouts ORDER BY plan, workout').fetchall()
+
+    def close(self):
+        self._db.close()
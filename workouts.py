@@ -1,26 +1,77 @@
 
-from bs4 import BeautifulSoup
-import jsonpickle
 import re
-import requests
 
+import instrument
 import intervals
+import workout_store
+
+
+# Responses worth retrying (after a backoff) rather than failing the page straight away
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# The fast parsing path only builds the parts of a page intervals are listed in, using lxml if
+# installed. bs4 (and lxml) are only imported once a page is first parsed, and requests once one
+# is first downloaded, so workouts that are already stored load without either.
+_HTML = {}
+
+
+def _html(name):
+    """`BeautifulSoup`, `HTML_PARSER`, `WORKOUT_LIST` or `PLAN_WORKOUTS`"""
+    if not _HTML:
+        from bs4 import BeautifulSoup, SoupStrainer
+        try:
+            import lxml
+            parser = 'lxml'
+        except ImportError:
+            parser = 'html.parser'
+        _HTML.update(BeautifulSoup=BeautifulSoup, HTML_PARSER=parser,
+                     WORKOUT_LIST=SoupStrainer('div', class_='workoutlist'),
+                     PLAN_WORKOUTS=SoupStrainer('article', class_='workout'))
+    return _HTML[name]
+
+
+def __getattr__(name):
+    # These used to be set up on import
+    if name in ('HTML_PARSER', 'WORKOUT_LIST', 'PLAN_WORKOUTS'):
+        return _html(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 class WorkoutLoader(object):
     """
     Loader object to manage extracting zwift workouts from "whatsonzwift"
 
-    Also manages saving and loading the intervals from a local cache if one is provided
+    Also manages saving and loading the intervals from a local `WorkoutStore` (`workouts.sqlite`
+    unless another store is provided). Newly scraped workouts are written to it straight away.
+    Pages are parsed with the fast path (see `_tokenize_workout`) unless `fast_parse` is turned off.
     """
 
-    def __init__(self, rider):
+    BASE_URL = 'https://whatsonzwift.com'
+
+    def __init__(self, rider, store=None, base_url=None, fast_parse=True):
         self._workout_namer = re.compile(r'workouts/(?P<plan>[^/]+)/(?P<workout>.*)')
         self._plan_namer = re.compile(r'workouts/(?P<plan>[^/]+)')
         self._watt_pct_re = re.compile(r'((?P<rwatts>\d+) to )?(?P<watts>\d+)W')
         self._rider = rider
-        # TODO(me): Allow for this to fail with an empty cache
-        with open('workouts.json') as f:
-            self._cache = jsonpickle.decode(f.read())
+        self._store = store if store is not None else workout_store.WorkoutStore()
+        self._base_url = base_url or self.BASE_URL
+        self._fast_parse = fast_parse
+        self._session = None
+        self._pool_size = 0
+
+    def _pooled_session(self, connections=10):
+        # Shared by every request so connections to the site are kept alive and reused. The pool
+        # only ever grows, to however many connections have been asked for at once.
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        if connections > self._pool_size:
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._pool_size = connections
+        return self._session
 
     def _list_intervals(self, soup):
         return soup.find_all('div', class_='workoutlist')[0].find_all('div', class_='textbar')
@@ -37,8 +88,34 @@ class WorkoutLoader(object):
                 t = f'{pct_ftp} to {t}'
             text = text.replace(text[m.start():m.end()], t)
 
+    @instrument.timed('scrape_workout')
     def _scrape_whatsonzwift(self, url):
-        s = BeautifulSoup(requests.get(url).content, "html.parser")
+        return self._parse_workout_page(self._pooled_session().get(url).content)
+
+    def _displays_watts(self, content):
+        marker = '>View %FTP<'
+        return (marker.encode() if isinstance(content, bytes) else marker) in content
+
+    def _between(self, content, start, end):
+        # Cut the page down to the part intervals are listed in before any html parsing happens
+        start, end = (start.encode(), end.encode()) if isinstance(content, bytes) else (start, end)
+        first, last = content.find(start), content.rfind(end)
+        if first < 0:
+            return content
+        return content[first:] if last < first else content[first:last + len(end)]
+
+    def _tokenize_workout(self, elem, displays_watts):
+        # Only the interval texts are pulled out of the tree, everything else is the single pass tokenizer
+        texts = [t.text for t in elem.find('div', class_='workoutlist').find_all('div', class_='textbar')]
+        return intervals.Workout.parse(texts, self._rider.ftp if displays_watts else None)
+
+    @instrument.timed('parse_workout_page')
+    def _parse_workout_page(self, content):
+        if self._fast_parse:
+            s = _html('BeautifulSoup')(self._between(content, '<div class="workoutlist"', '</div>'), _html('HTML_PARSER'),
+                                       parse_only=_html('WORKOUT_LIST'))
+            return self._tokenize_workout(s, self._displays_watts(content))
+        s = _html('BeautifulSoup')(content, "html.parser")
         displays_watts = s.find(text=r'View %FTP') is not None
         return self._scrape_workout(s, displays_watts)
 
@@ -46,29 +123,28 @@ class WorkoutLoader(object):
         blocks = []
         for elem in self._list_intervals(s):
             txt = elem.text if not displays_watts else self._text_to_pct_ftp(elem.text)
-            block = intervals.parse_interval(txt)
-            blocks.extend(block.intervals())
-        return blocks
+            blocks.append(intervals.parse_interval(txt))
+        return intervals.Workout.from_intervals(blocks)
 
     def _generate_url(self, plan, workout):
-        return f'https://whatsonzwift.com/workouts/{plan}/{workout}'
+        return f"{self._base_url}/workouts/{plan.replace('_', '-')}/{workout.replace('_', '-')}"
 
     def _extract_workout_name(self, url, name):
         if url is None:
-            return name.split('.')
+            # Stored under the same names as workouts found through their url (or plan)
+            return [n.replace('-', '_') for n in name.split('.')]
         m = self._workout_namer.search(url)
         if not m:
             raise Exception("Failed to match expected workout plan url format")
         return m.group('plan').replace('-', '_'), m.group('workout').replace('-', '_')
 
+    @instrument.timed('load_workout')
     def load_workout(self, url=None, name=None):
         plan, workout = self._extract_workout_name(url=url, name=name)
-        intervals = self._cache.get(plan, {}).get(workout, [])
+        intervals = self._store.get(plan, workout)
         if not intervals:
             intervals = self._scrape_whatsonzwift(url or self._generate_url(plan, workout))
-            if plan not in self._cache:
-                self._cache[plan] = {}
-            self._cache[plan][workout] = intervals
+            self._store.put(plan, workout, intervals)
 
         return intervals
 
@@ -78,25 +154,135 @@ class WorkoutLoader(object):
             raise Exception("Failed to match expected workout plan url format")
         return m.group('plan').replace('-', '_')
 
-    def _generate_plan_url(self, plan, workout):
-        return f'https://whatsonzwift.com/workouts/{plan}'
+    def _generate_plan_url(self, plan):
+        return f"{self._base_url}/workouts/{plan.replace('_', '-')}"
 
+    @instrument.timed('scrape_plan')
     def _scrape_training_plan(self, url):
-        s = BeautifulSoup(requests.get(url).content, "html.parser")
+        return self._parse_plan_page(self._pooled_session().get(url).content)
+
+    @instrument.timed('parse_plan_page')
+    def _parse_plan_page(self, content):
+        if self._fast_parse:
+            s = _html('BeautifulSoup')(self._between(content, '<article', '</article>'), _html('HTML_PARSER'),
+                                       parse_only=_html('PLAN_WORKOUTS'))
+            displays_watts = self._displays_watts(content)
+            return {w['id'].replace('-', '_'): self._tokenize_workout(w, displays_watts) for w in s.find_all('article', class_='workout')}
+        s = _html('BeautifulSoup')(content, "html.parser")
         displays_watts = s.find(text=r'View %FTP') is not None
         workouts = {}
         for workout in s.find_all('article', class_='workout'):
             workouts[workout['id'].replace('-', '_')] = self._scrape_workout(workout, displays_watts)
         return workouts
 
+    @instrument.timed('load_plan')
     def load_plan(self, url=None, plan=None):
         name = plan if plan is not None else self._extract_plan_name(url)
-        workouts = self._cache.get(name, {})
+        workouts = self._store.get_plan(name)
         if not workouts:
             workouts = self._scrape_training_plan(url or self._generate_plan_url(name))
-            self._cache[name] = workouts
+            self._store.put_plan(name, workouts)
         return workouts
 
-    def save_cache(self):
-        with open('workouts.json', 'w') as f:
-            f.write(jsonpickle.encode(self._cache))
+    async def _fetch(self, loop, pool, url, retries, backoff):
+        # Conditional GET when the page has been stored before, so unchanged pages come back as a bare 304
+        headers = {}
+        etag, modified = self._store.validators(url)
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        import asyncio
+        import requests
+        session = self._pooled_session()
+        for attempt in range(retries + 1):
+            try:
+                response = await loop.run_in_executor(pool, lambda: session.get(url, headers=headers, timeout=30))
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get('Retry-After', '')
+                wait = int(retry_after) if retry_after.isdigit() else 0
+                error = Exception(f'{url} responded with {response.status_code}')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                wait, error = 0, e
+            if attempt == retries:
+                raise error
+            await asyncio.sleep(max(wait, backoff * 2 ** attempt))
+
+    async def prefetch(self, plans=(), workouts=(), concurrency=8, retries=3, backoff=.5, parse_workers=None):
+        """Download whole training plans (and single `plan.workout`s) into the store concurrently
+
+        At most `concurrency` requests are in flight over one pooled session, failed requests are
+        retried with an exponential backoff and pages stored before are only downloaded again if
+        they've changed (ETag/Last-Modified). Pages are parsed on a pool of `parse_workers`
+        processes. Returns `fetched`, `unchanged` or the error for every plan and workout.
+        """
+        # Imported here as only prefetching needs them, not loading workouts
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(concurrency)
+        self._pooled_session(concurrency)
+
+        with ThreadPoolExecutor(concurrency) as io, \
+                ProcessPoolExecutor(parse_workers, initializer=_init_parser, initargs=(self._rider,)) as parsers:
+
+            async def refresh(url, is_plan, save):
+                async with limit:
+                    response = await self._fetch(loop, io, url, retries, backoff)
+                if response.status_code == 304:
+                    return 'unchanged'
+                save(await loop.run_in_executor(parsers, _parse_page, response.content, is_plan))
+                self._store.put_validators(url, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                return 'fetched'
+
+            tasks = {}
+            for plan in plans:
+                name = plan.replace('-', '_')
+                tasks[plan] = refresh(self._generate_plan_url(name), True,
+                                      lambda found, name=name: self._store.put_plan(name, found))
+            for workout in workouts:
+                plan, name = self._extract_workout_name(url=None, name=workout)
+                tasks[workout] = refresh(self._generate_url(plan, name), False,
+                                         lambda found, plan=plan, name=name: self._store.put(plan, name, found))
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        return {name: r if isinstance(r, str) else f'error: {r}' for name, r in zip(tasks, results)}
+
+    def cached_workouts(self):
+        return [f'{plan}.{workout}' for plan, workout in self._store.names()]
+
+
+# Parser for the worker processes of `WorkoutLoader.prefetch`, set up once per process by `_init_parser`
+_PARSER = None
+
+
+def _init_parser(rider):
+    global _PARSER
+    _PARSER = WorkoutLoader(rider, workout_store.WorkoutStore(':memory:', legacy_path=None))
+
+
+def _parse_page(content, is_plan):
+    return _PARSER._parse_plan_page(content) if is_plan else _PARSER._parse_workout_page(content)
+
+
+if __name__ == '__main__':
+    import argparse
+    import asyncio
+    import physics
+
+    p = argparse.ArgumentParser(prog='ZwiftWorkoutPrefetch')
+    p.add_argument('plan', nargs='*', help='training plan to download, as named in its url')
+    p.add_argument('-w', '--workout', action='append', default=[], help='single workout as plan.workout (repeatable)')
+    p.add_argument('-f', '--ftp', type=int, default=256, help='ftp to convert plans listed in watts with')
+    p.add_argument('-j', '--concurrency', type=int, default=8)
+    p.add_argument('--retries', type=int, default=3)
+    p.add_argument('--base-url', help='site to download from instead of whatsonzwift')
+    args = p.parse_args()
+
+    wl = WorkoutLoader(physics.Rider(90, 180, args.ftp), base_url=args.base_url)
+    results = asyncio.run(wl.prefetch(args.plan, args.workout, args.concurrency, args.retries))
+    for name, result in results.items():
+        print(f'{name}: {result}')
@@ -1,36 +1,50 @@
 
-import argparse
-
+import copy
+import logging
+import os
+import sys
+import time
+
+import engine
+from engine import split_time
+import instrument
+import intervals
 import physics
 import route
-import strava
-import workouts
 
 
-def split_time(t):
-    m, s = divmod(t, 60)
-    return f'{m:.0f}m{s:.0f}s'
+log = logging.getLogger(__name__)
 
 
 # Zwift simulation controllers
 class ZwiftRide(object):
     # iterator class for simulating a specific ride
-    DT = 0.1
+    DT = engine.DT
 
-    def __init__(self, rider, workout, route):
+    def __init__(self, rider, workout, route, checkpoints=None):
         self._rider = rider
         self._route = route
-        self._workout = workout
+        self._checkpoints = checkpoints
+        self._workout = workout if isinstance(workout, intervals.Workout) else intervals.Workout.from_intervals(workout)
 
         self._laps = []
         self._route.attach_lap_reporter(lap_reporter=self._report_lap)
-        self._workout_time = sum(i.duration for i in workout)
+        self._workout_time = self._workout.workout_time
 
         # Init physics variables
         self._timer = 0
+        self._tick = 0
         self._distance = 0
         self._climbed = 0
 
+        # Where the ride is up to, kept here rather than in the generators so it can be snapshot
+        self._interval, self._finished = 0, 0
+        # An empty lead-in isn't a lap, so the ride starts straight on the lap (as in `engine._integrate`)
+        self._on_lead_in = self._route.active_lap is self._route.lead_in and len(self._route.lead_in) > 0
+        self._segment, self._traveled = 0, 0
+
+        self._metrics = instrument.Metrics()
+
     @property
     def distance(self):
         return self._distance / 1000
@@ -38,89 +52,180 @@ class ZwiftRide(object):
     # For the "dt-interval" approach to work, this needs to have an internal
     # `interval_timer`
     def _iterate_workout(self):
-        finished = 0
-        for interval in self._workout:
-            print(f'==>Grabbed next interval segment: {interval}')
+        # Target watts of every interval are worked out up front in one go
+        durations = self._workout.durations.tolist()
+        watts = self._workout.watts(self._rider.ftp).tolist()
+        while self._interval < len(durations):
+            duration, target, finished = durations[self._interval], watts[self._interval], self._finished
+            log.debug('==>Grabbed next interval segment: %ss at %sW', duration, target)
             # Keep returning "this" interval until we have "traveled" the full duration
-            while self._timer - finished <= interval.duration:
-                yield interval
-            finished += interval.duration
+            while self._timer - finished <= duration:
+                yield target
+            self._finished += duration
+            self._interval += 1
 
     def _iterate_route(self):
-        traveled = 0
-        for segment in self._route:
-            print(f'==>Grabbed next route segment: {segment}')
+        for segment in self._route.iter_from(self._on_lead_in, self._segment):
+            log.debug('==>Grabbed next route segment: %s', segment)
             # Keep returning "this" segment until we have traveled the full length
+            traveled = self._traveled
             while traveled + segment.length > self._distance:
                 yield segment
-            traveled += segment.length
+            self._traveled = traveled + segment.length
             self._climbed += segment.elevation_gain
+            self._segment += 1
 
     def _report_lap(self):
         is_lead_in = (not self._laps) and self._route.has_lead_in()
-        rem = self._workout_time - self._timer
-        self._laps.append((split_time(self._timer), rem, is_lead_in))
-
-    def _report_progress(self, distance):
-        lap = self._route.active_lap
-        pct_complete = distance / lap.length
-        print(f'Workout completed with current lap only {pct_complete:.2%} complete ({distance:.2f}km out of {lap.length:.2f}km)')
-
-    def _report_completions(self):
-        distance = 0
-        lap_number = iter(range(len(self._laps)))
-        for t, rem, is_lead_in in self._laps:
-            name = 'Lead-In' if is_lead_in else f'Lap {next(lap_number)}'
-            print(f'{name} completed in {t} (with {rem:.2f}s left in workout)')
-            distance += self._route._leadin.length if is_lead_in else self._route._lap.length
-        return distance
-
-    def _report_totals(self):
-        print(f'In total, workout would travel {self.distance:.2f}km and climb {self._climbed:.2f}m')
-
-    def __iter__(self):
+        self._laps.append((self._timer, is_lead_in))
+        self._on_lead_in, self._segment = False, 0
+
+    def _simulate(self, every=None):
+        # Only builds a `(v, d, e, t)` tuple every `every` seconds of ride time, or never for None.
+        # A tick is complete by the time it's yielded, so the ride can be snapshot in between.
+        # Ticks are counted and the time spent simulating (not what's done with the trace) added
+        # up once the ride stops, so the loop itself isn't any slower for it.
+        mark = 0
+        first_tick, elapsed, start = self._tick, 0, time.perf_counter()
         segment_generator = self._iterate_route()
-        for interval in self._iterate_workout():
-            segment = next(segment_generator)
-
-            # Technically inaccurate, but close enough for the simulation
-            old_v = self._rider.velocity
-            self._distance += old_v * self.DT
+        try:
+            for watts in self._iterate_workout():
+                segment = next(segment_generator)
+
+                # Technically inaccurate, but close enough for the simulation
+                old_v = self._rider.velocity
+                self._distance += old_v * self.DT
+
+                self._rider.apply_watts(watts, segment.gradient, self.DT, self._route.surfaces)
+
+                t = self._timer
+                self._timer += self.DT
+                self._tick += 1
+                if every is not None and t >= mark:
+                    elapsed += time.perf_counter() - start
+                    yield (old_v, self.distance, self._climbed, t)
+                    start = time.perf_counter()
+                    mark += every
+        finally:
+            self._metrics.add_time('simulate', elapsed + time.perf_counter() - start)
+            self._metrics.count('ticks', self._tick - first_tick)
+
+    def snapshot(self):
+        """The ride so far as an `engine.RideState`, to `restore` or `fork` from later
+
+        Taken between ticks, ie. before the ride starts, while a `trace` is suspended or once
+        it's over. The state is plain values (so it pickles) and `engine._integrate` can carry
+        on from it just the same.
+        """
+        lap_start = len(self._route.lead_in)
+        state = engine.RideState(self._rider.velocity)
+        state.d, state.t, state.tick, state.climbed = self._distance, self._timer, self._tick, self._climbed
+        state.i = self._segment if self._on_lead_in else lap_start + self._segment
+        state.traveled, state.laps = self._traveled, list(self._laps)
+        # Only a ride restored at the end of its lead-in (see `engine.Checkpoints`) can still be there
+        state.paused = self._on_lead_in and self._segment == lap_start
+
+        return state
+
+    def restore(self, state):
+        """Carry on from `state` (from `snapshot`, or `engine._integrate` on the same route) from now on"""
+        lap_start = len(self._route.lead_in)
+        self._rider.velocity = state.v
+        self._timer, self._tick, self._distance, self._climbed = state.t, state.tick, state.d, state.climbed
+        self._traveled, self._laps = state.traveled, list(state.laps)
+        # A state paused on reaching the lap still has the lead-in to report
+        self._on_lead_in = state.i < lap_start or (state.paused and state.i == lap_start)
+        self._segment = state.i if self._on_lead_in else state.i - lap_start
+        # Intervals that are already over get skipped going by the timer alone
+        self._interval, self._finished = 0, 0
+
+    def fork(self, rider=None):
+        """Independent copy of the ride so far, carrying on with `rider` if given (eg. on another bike)"""
+        rider = rider if rider is not None else copy.copy(self._rider)
+        ride = ZwiftRide(rider, self._workout, copy.copy(self._route), self._checkpoints)
+        ride.restore(self.snapshot())
+        return ride
 
-            watts = interval.target(self._rider.ftp)
-            self._rider.apply_watts(watts, segment.gradient, self.DT, self._route.surfaces)
-
-            yield (old_v, self.distance, self._climbed, self._timer)
-            self._timer += self.DT
+    @property
+    def metrics(self):
+        """Counters and timers of the ride so far, as `instrument.Metrics.as_dict`"""
+        counters = engine.ride_counters(len(self._route.lap), self._laps, self.snapshot().i, self._interval)
+        return instrument.Metrics(self._metrics).merge(counters).as_dict()
+
+    def _summarize(self):
+        summary = engine.RideSummary(self._route.name, self._route.lead_in.length, self._route.lap.length,
+                                     self._workout_time, self._laps, self._distance, self._climbed, self._timer)
+        summary.metrics = self.metrics
+        return summary
+
+    def summary(self):
+        """Run (the rest of) the ride without producing any per-tick output
+
+        With `checkpoints` a ride that hasn't started carries on from where a cached ride with
+        the same lead-in left it, rather than riding the lead-in again.
+        """
+        if self._checkpoints is not None and self._tick == 0:
+            state = self._checkpoints.lead_in(self._rider, *engine._profiles(self._workout, self._route, self.DT))
+            if state is not None:
+                self.restore(state)
+                self._metrics.count('checkpoint_ticks', state.tick)
+        for _ in self._simulate():
+            pass
+        return self._summarize()
+
+    def trace(self, every=0):
+        """Yield the ride state every `every` seconds (every tick for 0), then report the ride"""
+        yield from self._simulate(every)
+        self._summarize().report()
 
-        completed_lap_distance = self._report_completions()
-        self._report_progress(self.distance - completed_lap_distance)
-        self._report_totals()
+    def __iter__(self):
+        return self.trace()
 
 
 class ZwiftController(object):
     # general controller class for managing workout/route selection and loading
-    def __init__(self, rider, strava_client):
+    def __init__(self, rider, strava_client, bundle=None):
         self._rider = rider
         self._client = strava_client
+        self._bundle = bundle
 
     def set_workout(self, workout):
         self._workout = workout
 
-    def set_route(self, route_name):
-        self._route = route.load_route(route_name, self._client)
-
-    def start_ride(self):
+    def set_route(self, route_name, tolerance=None):
+        self._route = route.load_route(route_name, self._client, self._bundle, tolerance)
+
+    def start_ride(self, simulator='stepper'):
+        # Imported here as only the event and estimate simulators need it
+        import integrator
+        if simulator == 'engine':
+            return engine.FastRide(self._rider, self._workout, self._route)
+        if simulator == 'events':
+            return integrator.EventRide(self._rider, self._workout, self._route)
+        if simulator == 'estimate':
+            return integrator.EstimatedRide(self._rider, self._workout, self._route)
         return ZwiftRide(self._rider, self._workout, self._route)
 
-# TODO(me): Consider changing intervals into a "callable" state instead of translating ramps to a series of smaller intervals
+    def export_trace(self, path, every=0):
+        """Ride with the engine, streaming the trace to `path` (see `traces.TraceWriter`), and return the summary"""
+        # Imported here as only exporting traces needs it
+        import traces
+        return traces.export_trace(self._rider, self._workout, self._route, path, every)
+
 ## main
 # TODO(me): Should laps report completion in total time or "lap" time
 # TODO(me): Incorporate lap customization
 # TODO(me): Reporting slightly wrong (not reporting lead-in, negative completion of ongoing lap)
 # TODO(me): Looks like workouts are going slightly longer than they actually should be
+#   `-s events` removes the fixed DT overrun, the rest is `RampInterval.intervals` adding an extra 15s step
 if __name__ == '__main__':
+    import argparse
+    import stream_cache
+    import strava
+    import workouts
+
     p = argparse.ArgumentParser(prog='ZwiftEstimate')
+
     p.add_argument('route')
     p.add_argument('-w', '--workout', default='ftp-builder.week-5-day-2-threshold-development')
     p.add_argument('-m', '--weight', type=float, default=90)
@@ -128,20 +233,56 @@ if __name__ == '__main__':
     p.add_argument('-f', '--ftp', type=int, default=256)
     p.add_argument('-b', '--bike', default='emonda')
     p.add_argument('-c', '--wheels', default='meilensteins')
+    p.add_argument('-s', '--simulator', choices=['stepper', 'engine', 'events', 'estimate'], default='stepper',
+                   help='estimate is approximate (see `python integrator.py`) but near instant')
+    p.add_argument('--offline', action='store_true', help='only use segment streams from the local cache')
+    p.add_argument('--bundle', default='routes.npz', help='compiled routes from `python route.py`, used when present')
+    p.add_argument('--simplify', type=float, help='merge route segments to within this many metres of elevation')
+    p.add_argument('--summary', action='store_true', help='only report lap splits and totals')
+    p.add_argument('--trace-every', type=float, default=0, help='seconds of ride time between trace lines (0 for every tick)')
+    p.add_argument('--trace-output', help='.npz (or .parquet) file to write the trace to as columns, instead of printing it')
+    p.add_argument('--log-level', default='INFO', help='DEBUG also shows every interval and segment change')
+    p.add_argument('--metrics', action='store_true', help='print counters and timings of loading and the ride as json')
+    p.add_argument('--profile', choices=instrument.PROFILERS, help='profile the whole run and print a report')
+    p.add_argument('--profile-output', help='file to save the raw profile (pstats or tracemalloc snapshot) to')
     args = p.parse_args()
 
-    client = strava.load_from_config('strava_secrets.json')
-
-    me = physics.Rider(args.weight, args.height, args.ftp)
-    me.set_bike(physics.BIKES.get(args.bike))
-    me.set_wheels(physics.WHEELS.get(args.wheels))
-
-    zwift = ZwiftController(me, client)
-    zwift.set_route(args.route)
-
-    wl = workouts.WorkoutLoader(me)
-    zwift.set_workout(wl.load_workout(name=args.workout))
-
-    for v, d, e, t in zwift.start_ride():
-        ts = split_time(t)
-        print(f't={ts} r={me} v={v*3.6:.2f}kph d={d:.2f}km e={e:.2f}m')
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s', stream=sys.stdout)
+
+    with instrument.profiled(args.profile, args.profile_output):
+        client = stream_cache.CachedClient(stream_cache.StreamCache(),
+                                           connect=lambda: strava.load_from_config('strava_secrets.json'),
+                                           offline=args.offline)
+
+        me = physics.Rider(args.weight, args.height, args.ftp)
+        me.set_bike(physics.BIKES.get(args.bike))
+        me.set_wheels(physics.WHEELS.get(args.wheels))
+
+        bundle = route.RouteBundle(args.bundle) if os.path.exists(args.bundle) else None
+        zwift = ZwiftController(me, client, bundle)
+        zwift.set_route(args.route, args.simplify)
+
+        wl = workouts.WorkoutLoader(me)
+        zwift.set_workout(wl.load_workout(name=args.workout))
+
+        if args.simplify:
+            full = route.load_route(args.route, client, bundle)
+            r = engine.simplification_report(me, wl.load_workout(name=args.workout), full, args.simplify)
+            print(f"Simplified {r['segments']} segments to {r['simplified_segments']} ({r['reduction']:.1%} fewer), "
+                  f"changing the estimate by {r['distance_delta_m']:+.1f}m and lap splits by up to {r['max_split_delta_s']:.1f}s")
+
+        ride = zwift.start_ride(args.simulator)
+        if args.trace_output:
+            # Always the engine's ticks, whichever simulator is picked
+            summary = zwift.export_trace(args.trace_output, args.trace_every)
+            summary.report()
+        elif args.summary:
+            ride.summary().report()
+        else:
+            for v, d, e, t in ride.trace(args.trace_every):
+                ts = split_time(t)
+                print(f't={ts} r={me} v={v*3.6:.2f}kph d={d:.2f}km e={e:.2f}m')
+
+    if args.metrics:
+        ride_metrics = summary.metrics if args.trace_output else ride.metrics
+        print(instrument.Metrics(instrument.METRICS).merge(ride_metrics).to_json(indent=2))